@@ -1,4 +1,5 @@
-from pipestat.api import pipestat
+from pipestat.api import pipestat, pipestat_iter
+from pipestat.parallel import pipestat_parallel, pipestat_partitioned, pipestat_pipelined
 from pipestat.models import Document, undefined
 from pipestat.pipeline import Pipeline
 from pipestat.errors import PipeStatError, PipelineError, OperatorError, CommandError, LimitCompleted
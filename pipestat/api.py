@@ -2,13 +2,21 @@
 
 from pipestat.pipeline import Pipeline
 from pipestat.errors import LimitCompleted
+from pipestat.constants import BATCH_SIZE
+from pipestat.utils import batches
 
 
-def pipestat(dataset, pipeline):
-    p = Pipeline(pipeline)
+def pipestat(dataset, pipeline, batch_size=BATCH_SIZE, buffer_size=None):
+    p = Pipeline(pipeline, buffer_size=buffer_size)
     try:
-        for item in dataset:
-            p.feed(item)
+        for items in batches(dataset, batch_size):
+            p.feed_many(items)
     except LimitCompleted:
         pass
     return p.result()
+
+
+def pipestat_iter(dataset, pipeline, batch_size=BATCH_SIZE, buffer_size=None):
+    """generator version of pipestat, see Pipeline.stream"""
+    p = Pipeline(pipeline, buffer_size=buffer_size)
+    return p.stream(dataset, batch_size=batch_size)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+
+_name_re = re.compile(r"^_[vc]\d+$")
+
+
+class CodeGen(object):
+    """Build source of one python function and exec it.
+
+    constants the source needs are bound in the function globals,
+    `const` returns the name bound to a value, `var` a fresh local name.
+    `remember` keeps the local holding a value for later `recall`, only
+    code in the same or nested blocks can recall it.
+
+    >>> gen = CodeGen("_double", ["doc"])
+    >>> gen.emit("return doc[%s] * 2" % gen.const("elapse"))
+    >>> func = gen.build()
+    """
+
+    def __init__(self, name, args, namespace=None):
+        self.name = name
+        self.args = args
+        self.namespace = dict(namespace or {})
+        self.lines = []
+        self.level = 1
+        self._consts = {}
+        self._counter = 0
+        self._scopes = [{}]
+
+    def const(self, value):
+        key = id(value)
+        if key not in self._consts:
+            name = "_c%d" % len(self._consts)
+            self.namespace[name] = value
+            self._consts[key] = (name, value)
+        return self._consts[key][0]
+
+    def var(self):
+        self._counter += 1
+        return "_v%d" % self._counter
+
+    def emit(self, line):
+        self.lines.append("    " * self.level + line)
+
+    def assign(self, expr):
+        """emit assignment of expr to a fresh local, return the local,
+        names of locals and constants are returned as they are.
+        """
+        if _name_re.match(expr):
+            return expr
+        name = self.var()
+        self.emit("%s = %s" % (name, expr))
+        return name
+
+    def remember(self, key, name):
+        self._scopes[-1][key] = name
+
+    def recall(self, key):
+        for scope in reversed(self._scopes):
+            if key in scope:
+                return scope[key]
+        return None
+
+    def indent(self, scoped=True):
+        """start a block, locals remembered in a scoped block are only
+        recalled inside it, a try block need not be scoped.
+        """
+        self.level += 1
+        if scoped:
+            self._scopes.append({})
+
+    def dedent(self, scoped=True):
+        self.level -= 1
+        if scoped:
+            self._scopes.pop()
+
+    @property
+    def source(self):
+        head = "def %s(%s):" % (self.name, ", ".join(self.args))
+        return "\n".join([head] + self.lines) + "\n"
+
+    def build(self):
+        namespace = dict(self.namespace)
+        code = compile(self.source, "<pipestat %s>" % self.name, "exec")
+        exec code in namespace
+        func = namespace[self.name]
+        func.source = self.source
+        return func
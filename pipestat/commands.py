@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import heapq
+import tempfile
+import itertools
+import collections
 try:
-    import simplejson as json
+    import cPickle as pickle
 except ImportError:
-    import json
-import collections
-from pipestat.bsort import insort
+    import pickle
 from pipestat.errors import PipelineError, CommandError, LimitCompleted
-from pipestat.operator import OperatorFactory
-from pipestat.models import Document, undefined
-from pipestat.utils import Value, isNumberType
-from pipestat.constants import ASCENDING, DESCENDING, ArrayTypes
+from pipestat.operator import OperatorFactory, ProjectCombineOperator, ProjectValueOperator
+from pipestat.operator import compile_match, compile_project, compile_expression, compile_values
+from pipestat.models import Document, undefined, field_path
+from pipestat.utils import Value, isNumberType, group_key
+from pipestat.constants import ASCENDING, DESCENDING, ArrayTypes, ROOT
 from pipestat.constants import VALUE_TYPE_PLAIN, VALUE_TYPE_REFKEY, VALUE_TYPE_OPERATOR
 
 
@@ -57,15 +60,66 @@ class Command(object):
         else:
             self.documents.append(document)
 
+    def feed_batch(self, documents):
+        """feed a list of documents, commands override it to handle
+        the whole batch in one call instead of one call per document.
+        """
+        if self.next:
+            if documents:
+                feed_chunks(self.next, documents)
+        else:
+            self.documents.extend(documents)
+
     def result(self):
         if self.next:
             return self.next.result()
         else:
             return self.documents
 
+    def demand(self):
+        """number of documents which can be fed before a following $limit
+        is full, None if not limited. commands which pass every document
+        on before the $limit see at most this many in one batch, so
+        they never handle documents the $limit would not take.
+        """
+        if self.next:
+            return self.next.demand()
+        return None
+
     def make_error(self, message):
         return CommandError(message, self.name)
 
+    def explain(self):
+        """physical plan of this command, see Pipeline.explain"""
+        return {
+            "command": self.name,
+            "class": type(self).__name__,
+            "reads": sorted(self.reads()),
+            "writes": sorted(self.writes()),
+        }
+
+    def reads(self):
+        return set()
+
+    def writes(self):
+        return set()
+
+    def interpret(self):
+        """evaluate operators one by one instead of the compiled code"""
+
+
+def feed_chunks(cmd, documents):
+    """feed documents to cmd in batches no larger than its demand"""
+    start = 0
+    while start < len(documents):
+        demand = cmd.demand()
+        if demand is None:
+            size = len(documents)
+        else:
+            size = max(demand, 1)
+        cmd.feed_batch(documents[start:start+size])
+        start += size
+
 
 class MatchCommand(Command):
 
@@ -79,12 +133,30 @@ class MatchCommand(Command):
         for k, v in value.iteritems():
             operators.append(OperatorFactory.new_match(k, v))
         self.operators = operators
+        self.match = compile_match(operators, self.match_operators)
 
     def feed(self, document):
         if self.match(document):
             super(MatchCommand, self).feed(document)
 
-    def match(self, document):
+    def feed_batch(self, documents):
+        match = self.match
+        super(MatchCommand, self).feed_batch([doc for doc in documents if match(doc)])
+
+    def explain(self):
+        plan = super(MatchCommand, self).explain()
+        plan["operators"] = [op.explain() for op in self.operators]
+        if hasattr(self.match, "source"):
+            plan["source"] = self.match.source
+        return plan
+
+    def reads(self):
+        return _operator_fields(self.operators)
+
+    def interpret(self):
+        self.match = self.match_operators
+
+    def match_operators(self, document):
         matched = True
         for op in self.operators:
             if not op.match(document):
@@ -121,25 +193,53 @@ class ProjectCommand(Command):
         self.excludes = excludes
 
         if self.excludes:
-            self.feed = self.feed_excludes
+            self.project = self.project_excludes
         else:
-            self.feed = self.feed_operators
+            self.project = compile_project(operators, self.project_operators)
+
+    def interpret(self):
+        if not self.excludes:
+            self.project = self.project_operators
+
+    def explain(self):
+        plan = super(ProjectCommand, self).explain()
+        plan["operators"] = [_explain_field(k, op) for k, op in self.operators]
+        if self.excludes:
+            plan["excludes"] = sorted(self.excludes)
+        if hasattr(self.project, "source"):
+            plan["source"] = self.project.source
+        return plan
+
+    def reads(self):
+        if self.excludes:
+            return set([ROOT])
+        return _operator_fields(op for k, op in self.operators)
+
+    def writes(self):
+        if self.excludes:
+            return set([ROOT])
+        return set(k for k, op in self.operators)
+
+    def feed(self, document):
+        super(ProjectCommand, self).feed(self.project(document))
+
+    def feed_batch(self, documents):
+        super(ProjectCommand, self).feed_batch(map(self.project, documents))
 
-    def feed_operators(self, document):
+    def project_operators(self, document):
         new_doc = Document()
         for k, op in self.operators:
             v = op.project(document)
             if v != undefined:
                 new_doc.set(k, v)
+        return new_doc
 
-        super(ProjectCommand, self).feed(new_doc)
-
-    def feed_excludes(self, document):
+    def project_excludes(self, document):
         new_doc = Document()
         for k, v in document.iteritems():
             if k not in self.excludes:
                 new_doc.set(k, v)
-        super(ProjectCommand, self).feed(new_doc)
+        return new_doc
 
 
 class GroupCommand(Command):
@@ -160,69 +260,297 @@ class GroupCommand(Command):
         self.operators = operators
 
         id_v = value["_id"]
+        self._id_fields = None
         if Value.is_doc_ref_key(id_v):
             self._id = id_v[1:]
             self._id_type = VALUE_TYPE_REFKEY
+            self._id_path = field_path(self._id)
         elif isinstance(id_v, dict):
             self._id = OperatorFactory.new_project("_id", id_v)
             self._id_type = VALUE_TYPE_OPERATOR
+            if isinstance(self._id, ProjectCombineOperator):
+                self._id_fields = [k for k, op in self._id.combined_ops]
+                self._id_project = compile_values([op for k, op in self._id.combined_ops], self.combined_id)
+            else:
+                self._id_project = compile_expression(self._id, self._id.project, error_op=self._id)
         else:
             self._id = id_v
             self._id_type = VALUE_TYPE_PLAIN
 
-        self._id_docs = {}
-
-    def init_doc(self, ids):
-        doc = Document(_id=ids)
+        self.reset()
+        # group tables are spilled to partition files when more than
+        # buffer_size groups are in memory, None means no limit.
+        self.buffer_size = None
+        self.partitions = None
+
+    def reset(self):
+        # group table: key of _id => int group id, which indexes the
+        # _id values and the accumulator column of every operator.
+        self._groups = {}
+        self._ids = []
+        self._columns = [(k, op, []) for k, op in self.operators]
+
+    def interpret(self):
+        if self._id_type == VALUE_TYPE_OPERATOR:
+            if self._id_fields is None:
+                self._id_project = self._id.project
+            else:
+                self._id_project = self.combined_id
+            self._id.interpret()
         for k, op in self.operators:
-            doc.set(k, op.init_val())
-        return doc
+            op.interpret()
 
-    def feed(self, document):
-        ids = self.gen_id(document)
-        hid = self.hash_id(ids)
-        if hid in self._id_docs:
-            acc_doc = self._id_docs[hid]
-        else:
-            acc_doc = self._id_docs[hid] = self.init_doc(ids)
+    def explain(self):
+        plan = super(GroupCommand, self).explain()
+        operators = []
+        if self._id_type == VALUE_TYPE_OPERATOR:
+            operators.append(_explain_field("_id", self._id))
+        operators.extend(_explain_field(k, op) for k, op in self.operators)
+        plan["operators"] = operators
+        return plan
+
+    def reads(self):
+        reads = _operator_fields(op for k, op in self.operators)
+        if self._id_type == VALUE_TYPE_REFKEY:
+            reads.add(self._id)
+        elif self._id_type == VALUE_TYPE_OPERATOR:
+            reads |= self._id.fields()
+        return reads
 
-        for k, op in self.operators:
-            acc_doc.set(k, op.group(document, acc_doc.get(k)))
+    def demand(self):
+        # every document may change a group
+        return None
+
+    def writes(self):
+        return set(["_id"] + [k for k, op in self.operators])
+
+    def feed(self, document):
+        self.group(document)
+        if self.buffer_size and len(self._ids) >= self.buffer_size:
+            self.spill()
+
+    def feed_batch(self, documents):
+        group = self.group
+        for document in documents:
+            group(document)
+        if self.buffer_size and len(self._ids) >= self.buffer_size:
+            self.spill()
+
+    def group(self, document):
+        gid = self.group_id(self.gen_id(document))
+        for k, op, column in self._columns:
+            column[gid] = op.group(document, column[gid])
+
+    def group_id(self, ids):
+        """int id of the group of ids, a new group is added if not exist.
+
+        hashable ids are the table key as they are, others are
+        converted to canonical keys.
+        """
+        key = ids
+        try:
+            gid = self._groups.get(key)
+        except TypeError:
+            key = group_key(ids)
+            gid = self._groups.get(key)
+        if gid is None:
+            gid = self._groups[key] = len(self._ids)
+            self._ids.append(ids)
+            for k, op, column in self._columns:
+                column.append(op.init_val())
+        return gid
+
+    @property
+    def mergeable(self):
+        return all(op.mergeable for k, op in self.operators)
+
+    def state(self):
+        """group table as _id values and accumulator columns, which are
+        not normalized yet, see merge_state.
+        """
+        return self._ids, [column for k, op, column in self._columns]
+
+    def merge_state(self, ids, columns):
+        """merge group table of later documents returned by state"""
+        for i, group_ids in enumerate(ids):
+            gid = self.group_id(group_ids)
+            for (k, op, column), other in zip(self._columns, columns):
+                column[gid] = op.merge(column[gid], other[i])
+
+    def spill(self):
+        """write group table to partition files by hash of _id key,
+        only mergeable accumulators are spilled.
+        """
+        if not self.mergeable:
+            return
+        if self.partitions is None:
+            self.partitions = [tempfile.TemporaryFile() for i in range(SPILL_PARTITIONS)]
+        parts = [[] for f in self.partitions]
+        for key, gid in self._groups.iteritems():
+            parts[hash(key) % len(parts)].append(gid)
+        for f, gids in zip(self.partitions, parts):
+            for i in xrange(0, len(gids), SPILL_CHUNK_SIZE):
+                chunk = gids[i:i+SPILL_CHUNK_SIZE]
+                ids = [self._ids[gid] for gid in chunk]
+                columns = [[column[gid] for gid in chunk] for k, op, column in self._columns]
+                pickle.dump((ids, columns), f, pickle.HIGHEST_PROTOCOL)
+        self.reset()
+
+    def merge_result(self):
+        """merge spilled group tables partition by partition, every
+        partition is normalized and fed to the next command in turn.
+        """
+        self.spill()
+        partitions, self.partitions = self.partitions, None
+        try:
+            for f in partitions:
+                f.seek(0)
+                while True:
+                    try:
+                        ids, columns = pickle.load(f)
+                    except EOFError:
+                        break
+                    self.merge_state(ids, columns)
+                documents = self.normalize()
+                self.reset()
+                if self.next:
+                    feed_chunks(self.next, documents)
+                else:
+                    self.documents.extend(documents)
+        except LimitCompleted:
+            pass
+        finally:
+            for f in partitions:
+                f.close()
+        if self.next:
+            return self.next.result()
+        return self.documents
 
     def result(self):
-        self.normalize()
+        if self.partitions:
+            return self.merge_result()
+        documents = self.normalize()
 
         if self.next:
             try:
-                for doc in self._id_docs.itervalues():
-                    self.next.feed(doc)
+                feed_chunks(self.next, documents)
             except LimitCompleted:
                 pass
             return self.next.result()
         else:
-            return self._id_docs.values()
-
-    def normalize(self):
-        for acc_doc in self._id_docs.itervalues():
-            for k, op in self.operators:
-                acc_doc.set(k, op.result(acc_doc.get(k)))
+            return documents
+
+    def normalize(self, gids=None):
+        if gids is None:
+            gids = range(len(self._ids))
+        documents = [Document(_id=self.make_id(self._ids[gid])) for gid in gids]
+        for k, op, column in self._columns:
+            for doc, gid in zip(documents, gids):
+                doc.set(k, op.result(column[gid]))
+        return documents
+
+    def sorted_by(self, keys):
+        """whether documents ordered by fields `keys` are ordered by _id"""
+        if self._id_type == VALUE_TYPE_REFKEY:
+            return keys[:1] == [self._id]
+        elif self._id_fields is not None:
+            fields = set()
+            for k, op in self._id.combined_ops:
+                if not isinstance(op, ProjectValueOperator) or op.value_type != VALUE_TYPE_REFKEY:
+                    return False
+                fields.add(op.value)
+            return set(keys[:len(fields)]) == fields
+        return False
+
+    def make_id(self, ids):
+        if self._id_fields is None:
+            return ids
+        return dict((k, v) for k, v in zip(self._id_fields, ids) if v is not undefined)
+
+    def combined_id(self, document):
+        """values of combined _id fields in order, undefined if missing"""
+        ids = self._id.project(document)
+        return tuple(ids.get(k, undefined) for k in self._id_fields)
 
     def gen_id(self, document):
         if self._id_type == VALUE_TYPE_REFKEY:
-            return document.get(self._id)
+            return self._id_path.get(document)
         elif self._id_type == VALUE_TYPE_OPERATOR:
-            return self._id.project(document)
+            return self._id_project(document)
         else:
             return self._id
 
-    def hash_id(self, ids):
-        try:
-            if isinstance(ids, dict):
-                return hash(frozenset(ids.items()))
-            else:
-                return hash(ids)
-        except Exception:
-            return hash(json.dumps({"_id": ids}))
+
+class SortedGroupCommand(GroupCommand):
+    """$group of documents ordered by _id, like the output of a $sort.
+
+    a group is finished once a document of another _id comes, so it is
+    normalized and fed to the next command right away, and only the open
+    group is kept. groups of _id None, or of combined _id with a None or
+    missing field, are kept open till the end: $sort orders a missing
+    field like None, so documents of such a group may not be adjacent.
+    """
+
+    def __init__(self, value):
+        super(SortedGroupCommand, self).__init__(value)
+        self._open = _no_group
+
+    def spill(self):
+        """only few groups are open, they are never spilled"""
+
+    def held(self, ids):
+        """whether the group of ids is kept open till the end"""
+        if self._id_fields is None:
+            return ids is None or ids is undefined
+        return any(v is None or v is undefined for v in ids)
+
+    def group(self, document):
+        ids = self.gen_id(document)
+        if not self.held(ids):
+            if self._open is not _no_group and ids != self._open:
+                self.finish()
+            self._open = ids
+        gid = self.group_id(ids)
+        for k, op, column in self._columns:
+            column[gid] = op.group(document, column[gid])
+
+    def finish(self):
+        """normalize and feed groups except held ones"""
+        held = [gid for gid, ids in enumerate(self._ids) if self.held(ids)]
+        if held:
+            gids = [gid for gid in range(len(self._ids)) if not self.held(self._ids[gid])]
+            groups = [(self._ids[gid], [column[gid] for k, op, column in self._columns])
+                      for gid in held]
+        else:
+            gids = None
+        documents = self.normalize(gids)
+        self.reset()
+        if held:
+            for ids, states in groups:
+                gid = self.group_id(ids)
+                for (k, op, column), acc_val in zip(self._columns, states):
+                    column[gid] = acc_val
+        self._open = _no_group
+        if self.next:
+            feed_chunks(self.next, documents)
+        else:
+            self.documents.extend(documents)
+
+    def result(self):
+        documents = self.normalize()
+        self.reset()
+        if self.next:
+            try:
+                feed_chunks(self.next, documents)
+            except LimitCompleted:
+                pass
+            return self.next.result()
+        else:
+            self.documents.extend(documents)
+            return self.documents
+
+
+_no_group = object()
 
 
 class SortCommand(Command):
@@ -247,40 +575,243 @@ class SortCommand(Command):
                 self.value = [(k, direction) for k, direction in value.iteritems()]
         else:
             raise self.make_error("$sort specification must be a list or a object")
+        self.paths = [field_path(k) for k, direction in self.value]
+        self.reverses = [direction == DESCENDING for k, direction in self.value]
+        self.entries = []
+        # sorted runs are spilled to temporary files when more than
+        # buffer_size entries are buffered, None means no limit.
+        self.buffer_size = None
+        self.runs = []
 
-    def feed(self, document):
-        insort(self.documents, document, cmp=self.cmp_func)
+    def reads(self):
+        return set(k for k, direction in self.value)
 
-    def cmp_func(self, doc1, doc2):
-        for k, direction in self.value:
-            if "." in k:
-                v1 = doc1.get(k)
-                v2 = doc2.get(k)
-            else:
-                v1 = doc1.get(k)
-                v2 = doc2.get(k)
-            ret = 0
-            if direction == ASCENDING:
-                ret = cmp(v1, v2)
-            else:
-                ret = cmp(v2, v1)
-            if ret == 0:
-                continue
+    def demand(self):
+        # every document may sort first
+        return None
+
+    def feed(self, document):
+        make_key = self.merge_key if self.buffer_size else self.make_key
+        self.entries.append((make_key(document), document))
+        if self.buffer_size and len(self.entries) >= self.buffer_size:
+            self.spill()
+
+    def feed_batch(self, documents):
+        make_key = self.merge_key if self.buffer_size else self.make_key
+        self.entries.extend((make_key(doc), doc) for doc in documents)
+        if self.buffer_size and len(self.entries) >= self.buffer_size:
+            self.spill()
+
+    def spill(self):
+        """write buffered entries to a temporary file as a sorted run"""
+        self.sort_entries(self.entries)
+        f = tempfile.TemporaryFile()
+        documents = [e[1] for e in self.entries]
+        for i in xrange(0, len(documents), SPILL_CHUNK_SIZE):
+            pickle.dump(documents[i:i+SPILL_CHUNK_SIZE], f, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(f)
+        self.entries = []
+
+    def make_key(self, document):
+        return tuple(_sort_value(path.get(document)) for path in self.paths)
+
+    def merge_key(self, document):
+        """tuple ordering documents by `<`, values of descending fields
+        are wrapped to compare in reverse.
+
+        runs are merged by it, and entries are keyed by it too when runs
+        may be spilled, so the order does not depend on spilling, even
+        for values which are not totally ordered. in memory entries are
+        keyed by make_key, the wrapper is slow to compare.
+        """
+        if not any(self.reverses):
+            return self.make_key(document)
+        return tuple(_ReverseSortKey(_sort_value(path.get(document))) if reverse
+                     else _sort_value(path.get(document))
+                     for path, reverse in zip(self.paths, self.reverses))
+
+    def sort(self):
+        self.sort_entries(self.entries)
+        self.documents.extend(e[1] for e in self.entries)
+        self.entries = []
+
+    def sort_entries(self, entries):
+        """sort entries in place by their keys, entries with same key keep
+        their feed order.
+
+        keys of make_key are sorted in stable passes of same direction
+        fields, from the least significant to the most.
+        """
+        if self.buffer_size or not any(self.reverses):
+            entries.sort(key=_entry_key)
+            return
+        pos = len(self.value)
+        while pos > 0:
+            reverse = self.reverses[pos-1]
+            start = pos - 1
+            while start > 0 and self.reverses[start-1] == reverse:
+                start -= 1
+            if start == 0 and pos == len(self.value):
+                key = _entry_key
+            elif start == pos - 1:
+                key = lambda e, i=start: e[0][i]
             else:
-                return ret
-        return 0
+                key = lambda e, i=start, j=pos: e[0][i:j]
+            entries.sort(key=key, reverse=reverse)
+            pos = start
+
+    def merge_runs(self, runs):
+        """merge runs of documents in sorted order into one lazily,
+        documents with same key keep order of runs.
+        """
+        def decorate(i, run):
+            make_key = self.merge_key
+            for n, doc in enumerate(run):
+                yield make_key(doc), i, n, doc
+
+        for entry in heapq.merge(*[decorate(i, run) for i, run in enumerate(runs)]):
+            yield entry[-1]
 
     def result(self):
+        if self.runs:
+            return self.merge_result()
+        self.sort()
         if self.next:
             try:
-                for doc in self.documents:
-                    self.next.feed(doc)
+                feed_chunks(self.next, self.documents)
             except LimitCompleted:
                 pass
             return self.next.result()
         else:
             return self.documents
 
+    def merge_result(self):
+        """merge spilled runs and buffered entries, documents are read
+        from the runs only when the downstream commands need them.
+        """
+        self.sort_entries(self.entries)
+        runs = [_read_run(f) for f in self.runs]
+        runs.append(e[1] for e in self.entries)
+        documents = self.merge_runs(runs)
+        try:
+            if self.next:
+                try:
+                    while True:
+                        items = list(itertools.islice(documents, SPILL_CHUNK_SIZE))
+                        if not items:
+                            break
+                        feed_chunks(self.next, items)
+                except LimitCompleted:
+                    pass
+                return self.next.result()
+            else:
+                self.documents.extend(documents)
+                return self.documents
+        finally:
+            for f in self.runs:
+                f.close()
+            self.runs = []
+            self.entries = []
+
+
+class SortLimitCommand(SortCommand):
+    """$sort fused with the following $limit(and $skip)
+
+    only the first `limit` documents of sorted order can pass the $limit,
+    so entries are pruned to `limit` whenever twice of it are buffered.
+    """
+
+    def __init__(self, value, limit):
+        super(SortLimitCommand, self).__init__(value)
+        self.limit = limit
+
+    def explain(self):
+        plan = super(SortLimitCommand, self).explain()
+        plan["limit"] = self.limit
+        return plan
+
+    def feed(self, document):
+        super(SortLimitCommand, self).feed(document)
+        if len(self.entries) >= 2 * self.limit:
+            self.prune()
+
+    def feed_batch(self, documents):
+        super(SortLimitCommand, self).feed_batch(documents)
+        if len(self.entries) >= 2 * self.limit:
+            self.prune()
+
+    def prune(self):
+        self.sort_entries(self.entries)
+        del self.entries[self.limit:]
+
+
+SPILL_CHUNK_SIZE = 1000
+SPILL_PARTITIONS = 16
+
+
+def _read_run(f):
+    f.seek(0)
+    while True:
+        try:
+            documents = pickle.load(f)
+        except EOFError:
+            break
+        for doc in documents:
+            yield doc
+
+
+def _operator_fields(operators):
+    fields = set()
+    for op in operators:
+        fields |= op.fields()
+    return fields
+
+
+def _explain_field(key, operator):
+    plan = {"field": key}
+    plan.update(operator.explain())
+    return plan
+
+
+class _UndefinedSortKey(object):
+    """sort key stands for undefined value.
+
+    undefined's rich comparisons are all False, which make sort unstable,
+    this one has none, so python compare it with the default ordering.
+    """
+
+_undefined_sort_key = _UndefinedSortKey()
+
+
+class _ReverseSortKey(object):
+    """sort key which compares in reverse order of the wrapped one,
+    sort and tuple comparison only use `<` and `==`.
+    """
+
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def _entry_key(entry):
+    return entry[0]
+
+
+def _sort_value(v):
+    if v is undefined:
+        return _undefined_sort_key
+    return v
+
 
 class SkipCommand(Command):
 
@@ -294,12 +825,30 @@ class SkipCommand(Command):
             raise self.make_error("$skip specification must be numeric type")
         self._skiped = 0
 
+    def explain(self):
+        plan = super(SkipCommand, self).explain()
+        plan["skip"] = self.value
+        return plan
+
     def feed(self, document):
         if self._skiped >= self.value:
             super(SkipCommand, self).feed(document)
         else:
             self._skiped += 1
 
+    def feed_batch(self, documents):
+        remain = self.value - self._skiped
+        if remain > 0:
+            self._skiped += min(remain, len(documents))
+            documents = documents[remain:]
+        super(SkipCommand, self).feed_batch(documents)
+
+    def demand(self):
+        demand = super(SkipCommand, self).demand()
+        if demand is None:
+            return None
+        return demand + max(self.value - self._skiped, 0)
+
 
 class LimitCommand(Command):
 
@@ -313,6 +862,11 @@ class LimitCommand(Command):
             raise self.make_error("$limit specification must be numeric type")
         self._received = 0
 
+    def explain(self):
+        plan = super(LimitCommand, self).explain()
+        plan["limit"] = self.value
+        return plan
+
     def feed(self, document):
         if self._received < self.value:
             self._received += 1
@@ -320,6 +874,20 @@ class LimitCommand(Command):
         else:
             raise LimitCompleted('$limit alreay received %d documents' % self.value)
 
+    def feed_batch(self, documents):
+        remain = self.value - self._received
+        if len(documents) <= remain:
+            self._received += len(documents)
+            super(LimitCommand, self).feed_batch(documents)
+        else:
+            if remain > 0:
+                self._received += remain
+                super(LimitCommand, self).feed_batch(documents[:remain])
+            raise LimitCompleted('$limit alreay received %d documents' % self.value)
+
+    def demand(self):
+        return max(self.value - self._received, 0)
+
 
 class UnwindCommand(Command):
 
@@ -330,14 +898,40 @@ class UnwindCommand(Command):
         if not Value.is_doc_ref_key(value):
             raise self.make_error("$unwind field path references must be prefixed with a '$'")
         self.value = value[1:]
+        self.path = field_path(self.value)
+
+    def reads(self):
+        return set([self.value])
+
+    def writes(self):
+        return set([self.value])
 
     def feed(self, document):
-        vals = document.get(self.value, undefined)
-        if vals != undefined:
-            if not isinstance(vals, ArrayTypes):
-                raise self.make_error("$unwind value at end of field path must be an array")
-
-            for v in vals:
-                new_doc = Document(document)
-                new_doc.set(self.value, v)
-                super(UnwindCommand, self).feed(new_doc)
+        for new_doc in self.unwind(document):
+            super(UnwindCommand, self).feed(new_doc)
+
+    def feed_batch(self, documents):
+        demand = self.demand()
+        new_docs = []
+        for document in documents:
+            new_docs.extend(self.unwind(document))
+            # stop unwinding once the following $limit may be full
+            if demand is not None and len(new_docs) >= max(demand, 1):
+                super(UnwindCommand, self).feed_batch(new_docs)
+                demand = self.demand()
+                new_docs = []
+        super(UnwindCommand, self).feed_batch(new_docs)
+
+    def unwind(self, document):
+        vals = self.path.get(document, undefined)
+        if vals == undefined:
+            return []
+        if not isinstance(vals, ArrayTypes):
+            raise self.make_error("$unwind value at end of field path must be an array")
+
+        new_docs = []
+        for v in vals:
+            new_doc = Document(document)
+            new_doc.set(self.value, v)
+            new_docs.append(new_doc)
+        return new_docs
@@ -10,6 +10,12 @@ DateTypes = tuple(list(NumberTypes)+[date, datetime])
 
 ArrayTypes = (list, tuple, set)
 
+# documents fed to pipeline in one batch
+BATCH_SIZE = 1000
+
+# field name stands for the whole document in explain
+ROOT = "$$ROOT"
+
 
 # use for solve performance issue
 VALUE_TYPE_PLAIN = 0
@@ -16,6 +16,9 @@ class OperatorError(PipeStatError):
         self.command = command
         self.operator = operator
 
+    def __reduce__(self):
+        return (type(self), (self.args[0], self.command, self.operator))
+
 
 class CommandError(PipeStatError):
     """pipe command error"""
@@ -24,6 +27,9 @@ class CommandError(PipeStatError):
         super(CommandError, self).__init__(message)
         self.command = command
 
+    def __reduce__(self):
+        return (type(self), (self.args[0], self.command))
+
 
 class LimitCompleted(PipeStatError):
     """limit command completed"""
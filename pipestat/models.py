@@ -20,14 +20,107 @@ class _Undefined(object):
     def __nonzero__(self):
         return False
 
+    def __reduce__(self):
+        return "undefined"
+
 undefined = _Undefined()
 
 
+class FieldPath(object):
+    """Precompiled accessor of a dotted field path, same semantics as
+    Document.get: arrays met in the middle of path are traversed, and
+    the value is default if any part is missing.
+
+    single and two parts paths get specialized functions, use
+    field_path to share accessors of same path.
+
+    >>> path = field_path('flag.fin')
+    >>> val = path.get({'flag': {'fin': 1}}, undefined)
+    """
+
+    __slots__ = ["path", "parts", "last", "heads", "rest", "get"]
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = path.split(".")
+        self.last = self.parts[-1]
+        self.heads = list(enumerate(self.parts[:-1], 1))
+        if len(self.parts) == 1:
+            self.get = self._get_one
+        elif len(self.parts) == 2:
+            self.get = self._get_two
+        else:
+            self.get = self._get_many
+        self.rest = [None] + [field_path(".".join(self.parts[i:])) for i in range(1, len(self.parts))]
+
+    def _get_one(self, doc, default=None):
+        try:
+            return doc[self.path]
+        except Exception:
+            return default
+
+    def _get_two(self, doc, default=None):
+        try:
+            doc = doc[self.parts[0]]
+            if isinstance(doc, ArrayTypes):
+                return self._get_array(doc, 1)
+            return doc[self.parts[1]]
+        except Exception:
+            return default
+
+    def _get_many(self, doc, default=None):
+        try:
+            for i, part in self.heads:
+                doc = doc[part]
+                if isinstance(doc, ArrayTypes):
+                    return self._get_array(doc, i)
+            return doc[self.last]
+        except Exception:
+            return default
+
+    def _get_array(self, docs, i):
+        rest = self.rest[i]
+        if not rest.path:
+            return docs
+        values = []
+        for x in docs:
+            if not isinstance(x, dict):
+                x = Document(x)
+            v = rest.get(x, undefined)
+            if v is not undefined:
+                values.append(v)
+        return values
+
+
+class _InvalidPath(object):
+
+    def get(self, doc, default=None):
+        return default
+
+_invalid_path = _InvalidPath()
+
+_field_paths = {}
+
+
+def field_path(path):
+    """cached FieldPath of path"""
+    try:
+        return _field_paths[path]
+    except KeyError:
+        if not isinstance(path, basestring):
+            return _invalid_path
+        if len(_field_paths) > 10000:
+            _field_paths.clear()
+        fpath = _field_paths[path] = FieldPath(path)
+        return fpath
+    except TypeError:
+        return _invalid_path
+
+
 class Document(dict):
     """Dict Wrapper for nested key, for example: 'flag.fin'
 
-    v2 function is more slower than same function in dict,
-    so juge if comma in key before call function, that is ugly but faster.
+    values are got through cached FieldPath accessors.
 
     >>> doc = Document({'flag': {'fin': 1}})
     >>> val = doc.get('flag.fin')
@@ -35,20 +128,10 @@ class Document(dict):
 
     def get(self, key, default=None):
         try:
-            parts = key.split(".")
-            pcnt = len(parts)
-            doc = self
-            for i, part in enumerate(parts):
-                doc = doc[part]
-                if i != pcnt - 1 and isinstance(doc, ArrayTypes):
-                    remain_parts = ".".join(parts[i+1:])
-                    if remain_parts:
-                        doc = (Document(x).get(remain_parts, undefined) for x in doc)
-                        doc = [x for x in doc if x != undefined]
-                    break
-            return doc
+            path = _field_paths[key]
         except Exception:
-            return default
+            path = field_path(key)
+        return path.get(self, default)
 
     def set(self, key, value):
         parts = key.split(".")
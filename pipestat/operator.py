@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import re
-import time
 import string
 import types
 from datetime import datetime, date
 from pipestat.errors import PipelineError, CommandError, OperatorError
-from pipestat.utils import Value, isNumberType
-from pipestat.models import Document, undefined
-from pipestat.constants import NumberTypes, DateTypes, ArrayTypes
+from pipestat.utils import Value, isNumberType, required_literal, union_regex, TimestampParser, local_datetime
+from pipestat.models import Document, undefined, field_path
+from pipestat.constants import NumberTypes, DateTypes, ArrayTypes, ROOT
 from pipestat.constants import (
     VALUE_TYPE_PLAIN, VALUE_TYPE_REFKEY, VALUE_TYPE_OPERATOR
 )
 from pipestat.parse import Parser
+from pipestat.codegen import CodeGen
 
 
 _operators = {}
@@ -99,6 +99,47 @@ class Operator(object):
     def make_error(self, message):
         return OperatorError(message, self.command, self.name)
 
+    def runtime_error(self, e):
+        return self.make_error("%s runtime error: %s" % (self.name, e.message))
+
+    def explain(self):
+        return {
+            "operator": getattr(self, "name", None),
+            "class": type(self).__name__,
+            "reads": sorted(self.reads()),
+            "operands": [op.explain() for op in self.operands()],
+        }
+
+    def operands(self):
+        operands = []
+        for attr in ["bool_op", "value", "sub_ops", "combined_ops", "operators"]:
+            _collect_operators(getattr(self, attr, None), operands)
+        return operands
+
+    def reads(self):
+        """fields read by operator itself, ROOT means the whole document"""
+        return set()
+
+    def fields(self):
+        """fields read by operator and its operands"""
+        fields = set(self.reads())
+        for op in self.operands():
+            fields |= op.fields()
+        return fields
+
+    def interpret(self):
+        """evaluate operands one by one instead of the compiled code"""
+        for op in self.operands():
+            op.interpret()
+
+
+def _collect_operators(value, operators):
+    if isinstance(value, Operator):
+        operators.append(value)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _collect_operators(v, operators)
+
 
 class MatchOperator(Operator):
 
@@ -110,11 +151,151 @@ class MatchOperator(Operator):
         except OperatorError:
             raise
         except Exception, e:
-            raise self.make_error("%s runtime error: %s" % (self.name, e.message))
+            raise self.runtime_error(e)
 
     def eval(self, document):
         raise NotImplemented()
 
+    def compile(self, gen, doc):
+        """emit code evaluating this operator on `doc` into gen,
+        return the expression of the result, see compile_match.
+        """
+        return "bool(%s(%s))" % (gen.const(self.match), doc)
+
+
+def compile_match(operators, fallback):
+    """compile match operators(all must match) into one function.
+
+    field access code is resolved once, arrays and undefined keep the
+    semantics of operators. a runtime error of an operator is left to
+    its interpreted version, which raises the operator error, so other
+    operators are not evaluated again. `fallback` is used when the
+    specification can not be compiled.
+    """
+    gen = CodeGen("match", ["doc"], namespace=_match_namespace)
+    res = _compile_all(gen, operators, "doc")
+    gen.emit("return %s" % res)
+    try:
+        return gen.build()
+    except Exception:
+        # too deep nested specification
+        return fallback
+
+
+class _CallError(Exception):
+    """error raised by a user callable in compiled code, which is raised
+    as the interpreted code does instead of calling it again.
+    """
+
+    def __init__(self, error):
+        super(_CallError, self).__init__(error)
+        self.error = error
+
+
+def _compile_guarded(gen, op, doc, fallback, error_op=None):
+    """emit code evaluating op into a local, return the local.
+
+    a runtime error calls `fallback`, the interpreted version of op,
+    an error of a user callable is raised by `error_op` like the
+    interpreted version does, as it is if error_op is None.
+    """
+    v, e = gen.var(), gen.var()
+    gen.emit("try:")
+    gen.indent(scoped=False)
+    gen.emit("%s = %s" % (v, op.compile(gen, doc)))
+    gen.dedent(scoped=False)
+    gen.emit("except _OperatorError:")
+    gen.indent()
+    gen.emit("raise")
+    gen.dedent()
+    gen.emit("except _CallError, %s:" % e)
+    gen.indent()
+    if error_op is None:
+        gen.emit("raise %s.error" % e)
+    else:
+        gen.emit("raise %s(%s.error)" % (gen.const(error_op.runtime_error), e))
+    gen.dedent()
+    gen.emit("except Exception:")
+    gen.indent()
+    gen.emit("%s = %s(%s)" % (v, gen.const(fallback), doc))
+    gen.dedent()
+    return v
+
+
+def _compile_user_call(gen, call):
+    """emit code of a call to a user callable into a local, return the
+    local, its errors are raised as _CallError.
+    """
+    v, e = gen.var(), gen.var()
+    gen.emit("try:")
+    gen.indent(scoped=False)
+    gen.emit("%s = %s" % (v, call))
+    gen.dedent(scoped=False)
+    gen.emit("except _OperatorError:")
+    gen.indent()
+    gen.emit("raise")
+    gen.dedent()
+    gen.emit("except Exception, %s:" % e)
+    gen.indent()
+    gen.emit("raise _CallError(%s)" % e)
+    gen.dedent()
+    return v
+
+
+_match_namespace = {
+    "_undefined": undefined,
+    "_ArrayTypes": ArrayTypes,
+    "_NumberTypes": NumberTypes,
+    "_dict_get": dict.get,
+    "_OperatorError": OperatorError,
+    "_CallError": _CallError,
+}
+
+_project_namespace = dict(_match_namespace, **{
+    "_Document": Document,
+    "_document_set": Document.set.im_func,
+    "_lower": string.lower,
+    "_upper": string.upper,
+})
+
+
+def _field_getter(gen, key, doc, default="_undefined"):
+    if "." in key:
+        return "%s(%s, %s)" % (gen.const(field_path(key).get), doc, default)
+    return "_dict_get(%s, %r, %s)" % (doc, key, default)
+
+
+def _compile_all(gen, operators, doc):
+    res = gen.var()
+    gen.emit("%s = False" % res)
+    gen.emit("while True:")
+    gen.indent()
+    for op in operators:
+        gen.emit("if not %s:" % _compile_guarded(gen, op, doc, op.match, op))
+        gen.indent()
+        gen.emit("break")
+        gen.dedent()
+    gen.emit("%s = True" % res)
+    gen.emit("break")
+    gen.dedent()
+    return res
+
+
+def _compile_any(gen, operators, doc):
+    res = gen.var()
+    gen.emit("%s = True" % res)
+    gen.emit("while True:")
+    gen.indent()
+    for op in operators:
+        gen.emit("if %s:" % _compile_guarded(gen, op, doc, op.match, op))
+        gen.indent()
+        gen.emit("break")
+        gen.dedent()
+    gen.emit("%s = False" % res)
+    gen.emit("break")
+    gen.dedent()
+    return res
+
 
 class MatchElemOperator(MatchOperator):
 
@@ -132,18 +313,25 @@ class MatchElemOperator(MatchOperator):
                 return False
         return True
 
+    def compile(self, gen, doc):
+        return _compile_all(gen, self.operators, doc)
+
 
 class MatchKeyOperator(MatchOperator):
 
     def __init__(self, key, value):
         self.key = key
         self.value = value
+        self.path = field_path(key)
+
+    def reads(self):
+        return set([self.key])
 
 
 class MatchKeyElemOperator(MatchKeyOperator):
 
     def eval(self, document):
-        doc_val = document.get(self.key, undefined)
+        doc_val = self.path.get(document, undefined)
         if isinstance(doc_val, ArrayTypes):
             for v in doc_val:
                 m = self._eval_val(v, document)
@@ -153,6 +341,31 @@ class MatchKeyElemOperator(MatchKeyOperator):
         else:
             return self._eval_val(doc_val, document)
 
+    def compile(self, gen, doc):
+        val, res, item = gen.var(), gen.var(), gen.var()
+        gen.emit("%s = %s" % (val, _field_getter(gen, self.key, doc)))
+        gen.emit("if isinstance(%s, _ArrayTypes):" % val)
+        gen.indent()
+        gen.emit("%s = False" % res)
+        gen.emit("for %s in %s:" % (item, val))
+        gen.indent()
+        gen.emit("if %s:" % self.compile_val(gen, item, doc))
+        gen.indent()
+        gen.emit("%s = True" % res)
+        gen.emit("break")
+        gen.dedent()
+        gen.dedent()
+        gen.dedent()
+        gen.emit("else:")
+        gen.indent()
+        gen.emit("%s = %s" % (res, self.compile_val(gen, val, doc)))
+        gen.dedent()
+        return res
+
+    def compile_val(self, gen, val, doc):
+        """expression of _eval_val"""
+        return "%s(%s, %s)" % (gen.const(self._eval_val), val, doc)
+
 
 class MatchExistsOperator(MatchKeyOperator):
 
@@ -164,13 +377,18 @@ class MatchExistsOperator(MatchKeyOperator):
             raise self.make_error("the $exists operator requires bool")
 
     def eval(self, document):
-        doc_val = document.get(self.key, undefined)
+        doc_val = self.path.get(document, undefined)
         if self.value and doc_val != undefined:
             return True
         elif not self.value and doc_val == undefined:
             return True
         return False
 
+    def compile(self, gen, doc):
+        if self.value:
+            return "(%s is not _undefined)" % _field_getter(gen, self.key, doc)
+        return "(%s is _undefined)" % _field_getter(gen, self.key, doc)
+
 
 class MatchRegexOperator(MatchKeyElemOperator):
 
@@ -184,15 +402,24 @@ class MatchRegexOperator(MatchKeyElemOperator):
             self.value = value
         else:
             raise self.make_error("the $regex operator requires regular expression")
+        self.literal = required_literal(self.value)
 
     def _eval_val(self, doc_val, document):
         if not isinstance(doc_val, basestring):
             return False
+        if self.literal is not None and self.literal not in doc_val:
+            return False
         m = self.value.search(doc_val)
         if m:
             return True
         return False
 
+    def compile_val(self, gen, val, doc):
+        expr = "not not %s(%s)" % (gen.const(self.value.search), val)
+        if self.literal is not None:
+            expr = "%r in %s and %s" % (self.literal, val, expr)
+        return "(isinstance(%s, basestring) and %s)" % (val, expr)
+
 
 class MatchModOperator(MatchKeyElemOperator):
 
@@ -223,19 +450,31 @@ class MatchModOperator(MatchKeyElemOperator):
             return True
         return False
 
+    def compile_val(self, gen, val, doc):
+        return "(isinstance(%s, _NumberTypes) and int(%s) %% %s == %s)" % (
+            val, val, gen.const(self.value[0]), gen.const(self.value[1]))
+
 
 class MatchCmpOperator(MatchKeyElemOperator):
 
+    symbol = None
+
     def _eval_val(self, doc_val, document):
         return self.cmp(doc_val, self.value)
 
     def cmp(self, doc_val, value):
         raise NotImplementedError()
 
+    def compile_val(self, gen, val, doc):
+        if self.symbol is None:
+            return super(MatchCmpOperator, self).compile_val(gen, val, doc)
+        return "(%s %s %s)" % (val, self.symbol, gen.const(self.value))
+
 
 class MatchLTOperator(MatchCmpOperator):
 
     name = "$lt"
+    symbol = "<"
 
     def cmp(self, doc_val, value):
         return doc_val < value
@@ -244,6 +483,7 @@ class MatchLTOperator(MatchCmpOperator):
 class MatchLTEOperator(MatchCmpOperator):
 
     name = "$lte"
+    symbol = "<="
 
     def cmp(self, doc_val, value):
         return doc_val <= value
@@ -252,6 +492,7 @@ class MatchLTEOperator(MatchCmpOperator):
 class MatchGTOperator(MatchCmpOperator):
 
     name = "$gt"
+    symbol = ">"
 
     def cmp(self, doc_val, value):
         return doc_val > value
@@ -260,6 +501,7 @@ class MatchGTOperator(MatchCmpOperator):
 class MatchGTEOperator(MatchCmpOperator):
 
     name = "$gte"
+    symbol = ">="
 
     def cmp(self, doc_val, value):
         return doc_val >= value
@@ -268,6 +510,7 @@ class MatchGTEOperator(MatchCmpOperator):
 class MatchEqualOperator(MatchCmpOperator):
 
     name = "$eq"
+    symbol = "=="
 
     def cmp(self, doc_val, value):
         return doc_val == value
@@ -276,6 +519,7 @@ class MatchEqualOperator(MatchCmpOperator):
 class MatchNotEqualOperator(MatchCmpOperator):
 
     name = "$ne"
+    symbol = "!="
 
     def cmp(self, doc_val, value):
         return doc_val != value
@@ -289,6 +533,10 @@ class MatchBelongOperator(MatchKeyElemOperator):
             super(MatchBelongOperator, self).__init__(key, value)
         else:
             raise self.make_error("the %s operator requires iterable" % self.name)
+        try:
+            self.hashed_value = frozenset(value)
+        except TypeError:
+            self.hashed_value = None
 
     def _eval_val(self, doc_val, document):
         return self.belong(doc_val, self.value)
@@ -296,6 +544,11 @@ class MatchBelongOperator(MatchKeyElemOperator):
     def belong(self, doc_val, value):
         raise NotImplementedError()
 
+    def compile_values(self, gen):
+        if self.hashed_value is None:
+            return gen.const(self.value)
+        return gen.const(self.hashed_value)
+
 
 class MatchInOperator(MatchBelongOperator):
 
@@ -304,6 +557,9 @@ class MatchInOperator(MatchBelongOperator):
     def belong(self, doc_val, value):
         return doc_val in value
 
+    def compile_val(self, gen, val, doc):
+        return "(%s in %s)" % (val, self.compile_values(gen))
+
 
 class MatchNotInOperator(MatchBelongOperator):
 
@@ -312,6 +568,9 @@ class MatchNotInOperator(MatchBelongOperator):
     def belong(self, doc_val, value):
         return doc_val not in value
 
+    def compile_val(self, gen, val, doc):
+        return "(%s not in %s)" % (val, self.compile_values(gen))
+
 
 class MatchAllOperator(MatchKeyOperator):
 
@@ -323,7 +582,7 @@ class MatchAllOperator(MatchKeyOperator):
             raise self.make_error("thie $all operator require array")
 
     def eval(self, document):
-        doc_val = document.get(self.key, undefined)
+        doc_val = self.path.get(document, undefined)
         if doc_val == undefined:
             return False
         if not isinstance(doc_val, ArrayTypes):
@@ -333,6 +592,27 @@ class MatchAllOperator(MatchKeyOperator):
                 return False
         return True
 
+    def compile(self, gen, doc):
+        val, res, item = gen.var(), gen.var(), gen.var()
+        gen.emit("%s = %s" % (val, _field_getter(gen, self.key, doc)))
+        gen.emit("%s = False" % res)
+        gen.emit("if %s is not _undefined:" % val)
+        gen.indent()
+        gen.emit("if not isinstance(%s, _ArrayTypes):" % val)
+        gen.indent()
+        gen.emit("%s = [%s]" % (val, val))
+        gen.dedent()
+        gen.emit("%s = True" % res)
+        gen.emit("for %s in %s:" % (item, gen.const(self.value)))
+        gen.indent()
+        gen.emit("if %s not in %s:" % (item, val))
+        gen.indent()
+        gen.emit("%s = False" % res)
+        gen.emit("break")
+        gen.dedent()
+        gen.dedent()
+        gen.dedent()
+        return res
 
 
 class MatchElemMatchOperator(MatchKeyOperator):
@@ -346,8 +626,11 @@ class MatchElemMatchOperator(MatchKeyOperator):
         else:
             raise self.make_error("the $elemMatch operator requires an object")
 
+    def fields(self):
+        return self.reads()
+
     def eval(self, document):
-        doc_val = document.get(self.key, undefined)
+        doc_val = self.path.get(document, undefined)
         if isinstance(doc_val, ArrayTypes):
             for v in doc_val:
                 if isinstance(v, dict):
@@ -358,6 +641,24 @@ class MatchElemMatchOperator(MatchKeyOperator):
         else:
             return False
 
+    def compile(self, gen, doc):
+        val, res, item = gen.var(), gen.var(), gen.var()
+        gen.emit("%s = %s" % (val, _field_getter(gen, self.key, doc)))
+        gen.emit("%s = False" % res)
+        gen.emit("if isinstance(%s, _ArrayTypes):" % val)
+        gen.indent()
+        gen.emit("for %s in %s:" % (item, val))
+        gen.indent()
+        gen.emit("if isinstance(%s, dict):" % item)
+        gen.indent()
+        gen.emit("if %s:" % self.value.compile(gen, item))
+        gen.indent()
+        gen.emit("%s = True" % res)
+        gen.emit("break")
+        for i in range(4):
+            gen.dedent()
+        return res
+
 
 class MatchCallOperator(MatchOperator):
 
@@ -368,11 +669,17 @@ class MatchCallOperator(MatchOperator):
         if not callable(value):
             raise self.make_error("the $call operator requires callable")
 
+    def reads(self):
+        return set([ROOT])
+
     def eval(self, document):
         if self.value(document):
             return True
         return False
 
+    def compile(self, gen, doc):
+        return "(not not %s)" % _compile_user_call(gen, "%s(%s)" % (gen.const(self.value), doc))
+
 
 class MatchLogicOperator(MatchOperator):
 
@@ -397,28 +704,120 @@ class MatchAndOperator(MatchLogicOperator):
                 return False
         return True
 
+    def compile(self, gen, doc):
+        return _compile_all(gen, self.sub_ops, doc)
+
 
 class MatchOrOperator(MatchLogicOperator):
 
     name = "$or"
 
+    def __init__(self, value):
+        super(MatchOrOperator, self).__init__(value)
+        self.sub_ops = fuse_alternatives(self.sub_ops)
+
     def eval(self, document):
         for sub_op in self.sub_ops:
             if sub_op.match(document):
                 return True
         return False
 
+    def compile(self, gen, doc):
+        return _compile_any(gen, self.sub_ops, doc)
+
 
 class MatchNorOperator(MatchLogicOperator):
 
     name = "$nor"
 
+    def __init__(self, value):
+        super(MatchNorOperator, self).__init__(value)
+        self.sub_ops = fuse_alternatives(self.sub_ops)
+
     def eval(self, document):
         for sub_op in self.sub_ops:
             if sub_op.match(document):
                 return False
         return True
 
+    def compile(self, gen, doc):
+        return "(not %s)" % _compile_any(gen, self.sub_ops, doc)
+
+
+def fuse_alternatives(sub_ops):
+    """replace $regex, string equality and $in of strings alternatives
+    on same field by one MatchAnyOfOperator, at the place of the first.
+    """
+    alternatives = {}
+    for sub_op in sub_ops:
+        op = sub_op.operators[0] if len(sub_op.operators) == 1 else None
+        if MatchAnyOfOperator.accepts(op):
+            alternatives.setdefault(op.key, []).append(sub_op)
+
+    fused = []
+    for sub_op in sub_ops:
+        op = sub_op.operators[0] if len(sub_op.operators) == 1 else None
+        alts = alternatives.get(getattr(op, "key", None))
+        if not alts or len(alts) < 2 or sub_op not in alts:
+            fused.append(sub_op)
+        elif sub_op is alts[0]:
+            fused.append(MatchAnyOfOperator(op.key, [alt.operators[0] for alt in alts]))
+    return fused
+
+
+class MatchAnyOfOperator(MatchKeyElemOperator):
+    """Any of alternatives on one field, string equalities are checked
+    in one set and regexes are searched as few alternations, so the cost
+    stays flat as alternatives grow.
+    """
+
+    def __init__(self, key, operators):
+        super(MatchAnyOfOperator, self).__init__(key, operators)
+        strings = set()
+        regexes = []
+        for op in operators:
+            if isinstance(op, MatchRegexOperator):
+                regexes.append(op.value)
+            elif isinstance(op, MatchInOperator):
+                strings.update(op.value)
+            else:
+                strings.add(op.value)
+        self.strings = frozenset(strings)
+        self.searches = [regex.search for regex in union_regex(regexes)]
+
+    @staticmethod
+    def accepts(op):
+        if isinstance(op, MatchRegexOperator):
+            return True
+        elif isinstance(op, MatchEqualOperator):
+            return isinstance(op.value, basestring)
+        elif isinstance(op, MatchInOperator):
+            return all(isinstance(v, basestring) for v in op.value)
+        return False
+
+    def explain(self):
+        explain = super(MatchAnyOfOperator, self).explain()
+        explain["alternatives"] = len(self.value)
+        return explain
+
+    def operands(self):
+        return []
+
+    def _eval_val(self, doc_val, document):
+        if not isinstance(doc_val, basestring):
+            return False
+        if doc_val in self.strings:
+            return True
+        for search in self.searches:
+            if search(doc_val):
+                return True
+        return False
+
+    def compile_val(self, gen, val, doc):
+        checks = ["%s in %s" % (val, gen.const(self.strings))] if self.strings else []
+        checks.extend("not not %s(%s)" % (gen.const(search), val) for search in self.searches)
+        return "(isinstance(%s, basestring) and (%s))" % (val, " or ".join(checks))
+
 
 class MatchNotOperator(MatchKeyOperator):
 
@@ -437,6 +836,9 @@ class MatchNotOperator(MatchKeyOperator):
         else:
             return True
 
+    def compile(self, gen, doc):
+        return "(not %s)" % self.value.compile(gen, doc)
+
 
 class MatchCombineOperator(MatchKeyOperator):
 
@@ -453,6 +855,9 @@ class MatchCombineOperator(MatchKeyOperator):
                 return False
         return True
 
+    def compile(self, gen, doc):
+        return _compile_all(gen, self.combined_ops, doc)
+
 
 class ProjectOperator(Operator):
 
@@ -463,17 +868,91 @@ class ProjectOperator(Operator):
         self.value = value
         self.value_type = VALUE_TYPE_PLAIN
 
+    def reads(self):
+        value_type = self.value_type
+        if isinstance(value_type, list):
+            values = zip(self.value, value_type)
+        elif isinstance(self.value, list):
+            values = [(self.value[0], value_type)]
+        else:
+            values = [(self.value, value_type)]
+        return set(v for v, vt in values if vt == VALUE_TYPE_REFKEY)
+
     def project(self, document):
         try:
             return self.eval(document)
         except OperatorError:
             raise
         except Exception, e:
-            raise self.make_error("%s runtime error: %s" % (self.name, e.message))
+            raise self.runtime_error(e)
 
     def eval(self, document):
         raise NotImplemented()
 
+    def compile(self, gen, doc):
+        """emit code evaluating this operator on `doc` into gen,
+        return the expression of the result, see compile_project.
+        """
+        return "%s(%s)" % (gen.const(self.eval), doc)
+
+    def compile_operand(self, gen, doc, value, value_type, default="None"):
+        if value_type == VALUE_TYPE_REFKEY:
+            return gen.assign(_field_getter(gen, value, doc, default))
+        elif value_type == VALUE_TYPE_OPERATOR:
+            return gen.assign(value.compile(gen, doc))
+        else:
+            return gen.const(value)
+
+
+def compile_project(operators, fallback):
+    """compile (key, operator) pairs of $project into one function
+    which returns the projected document, a runtime error of a field
+    is left to its interpreted operator as compile_match does.
+    """
+    gen = CodeGen("project", ["doc"], namespace=_project_namespace)
+    try:
+        new_doc = gen.assign("_Document()")
+        for k, op in operators:
+            v = _compile_guarded(gen, op, "doc", op.project, op)
+            gen.emit("if %s is not _undefined:" % v)
+            gen.indent()
+            if "." in k:
+                gen.emit("_document_set(%s, %r, %s)" % (new_doc, k, v))
+            else:
+                gen.emit("%s[%r] = %s" % (new_doc, k, v))
+            gen.dedent()
+        gen.emit("return %s" % new_doc)
+        return gen.build()
+    except Exception:
+        return fallback
+
+
+def compile_expression(operator, fallback, default="_undefined", error_op=None):
+    """compile one expression operator into function(doc), the result
+    undefined is replaced by `default`. `fallback` evaluates it on a
+    runtime error, see _compile_guarded for `error_op`.
+    """
+    gen = CodeGen("expression", ["doc"], namespace=_project_namespace)
+    try:
+        v = _compile_guarded(gen, operator, "doc", fallback, error_op)
+        gen.emit("return %s if %s is _undefined else %s" % (default, v, v))
+        return gen.build()
+    except Exception:
+        return fallback
+
+
+def compile_values(operators, fallback):
+    """compile expression operators into function(doc) returning tuple
+    of their results, undefined results are kept.
+    """
+    gen = CodeGen("values", ["doc"], namespace=_project_namespace)
+    try:
+        values = [_compile_guarded(gen, op, "doc", op.project, op) for op in operators]
+        gen.emit("return (%s)" % "".join(v + ", " for v in values))
+        return gen.build()
+    except Exception:
+        return fallback
+
 
 class ProjectValueOperator(ProjectOperator):
 
@@ -491,13 +970,18 @@ class ProjectValueOperator(ProjectOperator):
         else:
             self.value = value
             self.value_type = VALUE_TYPE_PLAIN
+        if self.value_type == VALUE_TYPE_REFKEY:
+            self.path = field_path(self.value)
 
     def eval(self, document):
         if self.value_type == VALUE_TYPE_REFKEY:
-            return document.get(self.value, undefined)
+            return self.path.get(document, undefined)
         else:
             return self.value
 
+    def compile(self, gen, doc):
+        return self.compile_operand(gen, doc, self.value, self.value_type, "_undefined")
+
 
 class ProjectExtractOperator(ProjectOperator):
 
@@ -526,6 +1010,14 @@ class ProjectExtractOperator(ProjectOperator):
                 raise self.make_error("$extract pattern must be regular expression")
         else:
             raise self.make_error("the $extract operator requires an array of two elements")
+        pattern = self.value[1]
+        if self.key in pattern.groupindex:
+            self.group = "extract"
+        elif pattern.groups > 0:
+            self.group = 1
+        else:
+            self.group = 0
+        self.literal = required_literal(pattern)
 
     def eval(self, document):
         v = self.value[0]
@@ -537,14 +1029,41 @@ class ProjectExtractOperator(ProjectOperator):
         if not isinstance(v, basestring):
             raise self.make_error("$extract source must be string type")
         else:
-            m = self.value[1].search(v)
-            if m:
-                if self.key in m.groupdict():
-                    return m.groupdict()["extract"]
-                elif len(m.groups()) > 0:
-                    return m.group(1)
-                else:
-                    return m.group()
+            return self.extract(v)
+
+    def extract(self, v):
+        if self.literal is not None and self.literal not in v:
+            return None
+        m = self.value[1].search(v)
+        if m:
+            return m.group(self.group)
+
+    def compile(self, gen, doc):
+        """$extracts of same field in one $project read and check the
+        field once, and share the search of same pattern.
+        """
+        source_key = ("$extract source", doc, self.value[0])
+        v = None
+        if self.value_type == VALUE_TYPE_REFKEY:
+            v = gen.recall(source_key)
+        if v is None:
+            v = self.compile_operand(gen, doc, self.value[0], self.value_type, "_undefined")
+            gen.emit("if not isinstance(%s, basestring):" % v)
+            gen.indent()
+            gen.emit("raise TypeError")
+            gen.dedent()
+            if self.value_type == VALUE_TYPE_REFKEY:
+                gen.remember(source_key, v)
+        pattern = self.value[1]
+        match_key = ("$extract match", v, pattern.pattern, pattern.flags)
+        m = gen.recall(match_key)
+        if m is None:
+            if self.literal is not None:
+                m = gen.assign("%s(%s) if %r in %s else None" % (gen.const(pattern.search), v, self.literal, v))
+            else:
+                m = gen.assign("%s(%s)" % (gen.const(pattern.search), v))
+            gen.remember(match_key, m)
+        return "(%s.group(%r) if %s else None)" % (m, self.group, m)
 
 
 class ProjectTimestampOperator(ProjectOperator):
@@ -571,6 +1090,7 @@ class ProjectTimestampOperator(ProjectOperator):
 
             if not isinstance(value[1], basestring):
                 raise self.make_error("$timestamp format must be string type")
+            self.parser = TimestampParser(value[1])
         else:
             raise self.make_error("the $timestamp operator requires an array of two elements")
 
@@ -584,7 +1104,18 @@ class ProjectTimestampOperator(ProjectOperator):
         if not isinstance(v, basestring):
             raise self.make_error("$timestamp source must be string type")
         else:
-            return time.mktime(time.strptime(v, self.value[1]))
+            return self.parse(v)
+
+    def parse(self, v):
+        return self.parser.parse(v)
+
+    def compile(self, gen, doc):
+        v = self.compile_operand(gen, doc, self.value[0], self.value_type)
+        gen.emit("if not isinstance(%s, basestring):" % v)
+        gen.indent()
+        gen.emit("raise TypeError")
+        gen.dedent()
+        return "%s(%s)" % (gen.const(self.parser.parse), v)
 
 
 class ProjectCmpOperator(ProjectOperator):
@@ -612,6 +1143,11 @@ class ProjectCmpOperator(ProjectOperator):
     def cmp(self, v1, v2):
         raise NotImplementedError()
 
+    def compile(self, gen, doc):
+        v1 = self.compile_operand(gen, doc, self.value[0], self.value_type[0])
+        v2 = self.compile_operand(gen, doc, self.value[1], self.value_type[1])
+        return "(%s %s %s)" % (v1, self.symbol, v2)
+
     def _get_val(self, document, value, value_type):
         if value_type == VALUE_TYPE_REFKEY:
             return document.get(value)
@@ -624,6 +1160,7 @@ class ProjectCmpOperator(ProjectOperator):
 class ProjectLTOperator(ProjectCmpOperator):
 
     name = "$lt"
+    symbol = "<"
 
     def cmp(self, v1, v2):
         return v1 < v2
@@ -632,6 +1169,7 @@ class ProjectLTOperator(ProjectCmpOperator):
 class ProjectLTEOperator(ProjectCmpOperator):
 
     name = "$lte"
+    symbol = "<="
 
     def cmp(self, v1, v2):
         return v1 <= v2
@@ -640,6 +1178,7 @@ class ProjectLTEOperator(ProjectCmpOperator):
 class ProjectGTOperator(ProjectCmpOperator):
 
     name = "$gt"
+    symbol = ">"
 
     def cmp(self, v1, v2):
         return v1 > v2
@@ -648,6 +1187,7 @@ class ProjectGTOperator(ProjectCmpOperator):
 class ProjectGTEOperator(ProjectCmpOperator):
 
     name = "$gte"
+    symbol = ">="
 
     def cmp(self, v1, v2):
         return v1 >= v2
@@ -656,6 +1196,7 @@ class ProjectGTEOperator(ProjectCmpOperator):
 class ProjectEqualOperator(ProjectCmpOperator):
 
     name = "$eq"
+    symbol = "=="
 
     def cmp(self, v1, v2):
         return v1 == v2
@@ -664,6 +1205,7 @@ class ProjectEqualOperator(ProjectCmpOperator):
 class ProjectNotEqualOperator(ProjectCmpOperator):
 
     name = "$ne"
+    symbol = "!="
 
     def cmp(self, v1, v2):
         return v1 != v2
@@ -718,11 +1260,30 @@ class ProjectDualNumberOperator(ProjectOperator):
     def compute(self, v1, v2):
         raise NotImplementedError()
 
+    def compile(self, gen, doc):
+        v1 = self.compile_operand(gen, doc, self.value[0], self.value_type[0])
+        v2 = self.compile_operand(gen, doc, self.value[1], self.value_type[1])
+        res = gen.var()
+        gen.emit("if isinstance(%s, _NumberTypes) and isinstance(%s, _NumberTypes):" % (v1, v2))
+        gen.indent()
+        gen.emit("%s = float(%s) %s float(%s)" % (res, v1, self.symbol, v2))
+        gen.dedent()
+        gen.emit("elif %s is None or %s is None or %s is _undefined or %s is _undefined:" % (v1, v2, v1, v2))
+        gen.indent()
+        gen.emit("%s = None" % res)
+        gen.dedent()
+        gen.emit("else:")
+        gen.indent()
+        gen.emit("raise TypeError")
+        gen.dedent()
+        return res
+
 
 class ProjectAddOperator(ProjectDualNumberOperator):
 
     name = "$add"
     returnTypes = NumberTypes
+    symbol = "+"
 
     def compute(self, v1, v2):
         return v1 + v2
@@ -732,6 +1293,7 @@ class ProjectSubtractOperator(ProjectDualNumberOperator):
 
     name = "$subtract"
     returnTypes = NumberTypes
+    symbol = "-"
 
     def compute(self, v1, v2):
         return v1 - v2
@@ -741,6 +1303,7 @@ class ProjectMultiplyOperator(ProjectDualNumberOperator):
 
     name = "$multiply"
     returnTypes = NumberTypes
+    symbol = "*"
 
     def compute(self, v1, v2):
         return v1 * v2
@@ -750,6 +1313,7 @@ class ProjectDivideOperator(ProjectDualNumberOperator):
 
     name = "$divide"
     returnTypes = NumberTypes
+    symbol = "/"
 
     def compute(self, v1, v2):
         return v1 / v2
@@ -759,6 +1323,7 @@ class ProjectModOperator(ProjectDualNumberOperator):
 
     name = "$mod"
     returnTypes = NumberTypes
+    symbol = "%"
 
     def compute(self, v1, v2):
         return v1 % v2
@@ -794,6 +1359,13 @@ class ProjectConvertOperator(ProjectOperator):
     def convert(self, v):
         raise NotImplementedError()
 
+    def compile(self, gen, doc):
+        v = self.compile_operand(gen, doc, self.value, self.value_type)
+        return self.compile_convert(gen, v)
+
+    def compile_convert(self, gen, v):
+        return "%s(%s)" % (gen.const(self.convert), v)
+
 
 class ProjectToLowerOperator(ProjectConvertOperator):
 
@@ -805,6 +1377,9 @@ class ProjectToLowerOperator(ProjectConvertOperator):
             return ""
         return string.lower(v)
 
+    def compile_convert(self, gen, v):
+        return '("" if %s is _undefined or %s is None else _lower(%s))' % (v, v, v)
+
 
 class ProjectToUpperOperator(ProjectConvertOperator):
 
@@ -816,6 +1391,9 @@ class ProjectToUpperOperator(ProjectConvertOperator):
             return ""
         return string.upper(v)
 
+    def compile_convert(self, gen, v):
+        return '("" if %s is _undefined or %s is None else _upper(%s))' % (v, v, v)
+
 
 class ProjectToNumberOperator(ProjectConvertOperator):
 
@@ -827,6 +1405,9 @@ class ProjectToNumberOperator(ProjectConvertOperator):
             return 0
         return float(v)
 
+    def compile_convert(self, gen, v):
+        return '(0 if %s is _undefined or %s is None else float(%s))' % (v, v, v)
+
 
 class ProjectUseOperator(ProjectOperator):
 
@@ -868,6 +1449,14 @@ class ProjectUseOperator(ProjectOperator):
         else:
             return self.value[1](v)
 
+    def compile(self, gen, doc):
+        v = self.compile_operand(gen, doc, self.value[0], self.value_type)
+        if len(self.value) == 3:
+            call = "%s(%s, **%s)" % (gen.const(self.value[1]), v, gen.const(self.value[2]))
+        else:
+            call = "%s(%s)" % (gen.const(self.value[1]), v)
+        return _compile_user_call(gen, call)
+
 
 class ProjectConcatOperator(ProjectOperator):
 
@@ -889,6 +1478,9 @@ class ProjectConcatOperator(ProjectOperator):
         else:
             raise self.make_error("the $concat operator requires an array of at least two elements")
 
+    def reads(self):
+        return set(v[1:] for v in self.value if Value.is_doc_ref_key(v))
+
     def eval(self, document):
         rets = []
         for v in self.value:
@@ -906,6 +1498,32 @@ class ProjectConcatOperator(ProjectOperator):
                 rets.append(rv)
         return "".join(rets)
 
+    def compile(self, gen, doc):
+        res = gen.assign("None")
+        gen.emit("while True:")
+        gen.indent()
+        parts = []
+        for v in self.value:
+            if isinstance(v, ProjectOperator):
+                rv = self.compile_operand(gen, doc, v, VALUE_TYPE_OPERATOR)
+            elif Value.is_doc_ref_key(v):
+                rv = self.compile_operand(gen, doc, v[1:], VALUE_TYPE_REFKEY)
+            else:
+                rv = self.compile_operand(gen, doc, v, VALUE_TYPE_PLAIN)
+            gen.emit("if %s is None or %s is _undefined:" % (rv, rv))
+            gen.indent()
+            gen.emit("break")
+            gen.dedent()
+            gen.emit("if not isinstance(%s, basestring):" % rv)
+            gen.indent()
+            gen.emit("raise TypeError")
+            gen.dedent()
+            parts.append(rv)
+        gen.emit('%s = "".join([%s])' % (res, ", ".join(parts)))
+        gen.emit("break")
+        gen.dedent()
+        return res
+
 
 class ProjectSubstrOperator(ProjectOperator):
 
@@ -953,6 +1571,9 @@ class ProjectSubstrOperator(ProjectOperator):
         else:
             return v[self.value[1]:self.value[2]]
 
+    def compile(self, gen, doc):
+        return _compile_slice(self, gen, doc)
+
 
 class ProjectSubstringOperator(ProjectOperator):
 
@@ -1003,6 +1624,27 @@ class ProjectSubstringOperator(ProjectOperator):
         else:
             return v[self.value[1]:self.value[2]]
 
+    def compile(self, gen, doc):
+        return _compile_slice(self, gen, doc)
+
+
+def _compile_slice(op, gen, doc):
+    v = op.compile_operand(gen, doc, op.value[0], op.value_type)
+    res = gen.var()
+    gen.emit("if %s is _undefined:" % v)
+    gen.indent()
+    gen.emit('%s = ""' % res)
+    gen.dedent()
+    gen.emit("elif not isinstance(%s, basestring):" % v)
+    gen.indent()
+    gen.emit("raise TypeError")
+    gen.dedent()
+    gen.emit("else:")
+    gen.indent()
+    gen.emit("%s = %s[%s:%s]" % (res, v, gen.const(op.value[1]), gen.const(op.value[2])))
+    gen.dedent()
+    return res
+
 
 
 class ProjectDateOperator(ProjectOperator):
@@ -1027,19 +1669,34 @@ class ProjectDateOperator(ProjectOperator):
         d = self._make_date(document)
         return self._eval(d)
 
+    def compile(self, gen, doc):
+        """date operators of same field in one $project convert it once"""
+        date_key = ("$date", doc, self.value)
+        d = None
+        if self.value_type == VALUE_TYPE_REFKEY:
+            d = gen.recall(date_key)
+        if d is None:
+            v = self.compile_operand(gen, doc, self.value, self.value_type)
+            d = gen.assign("%s(%s)" % (gen.const(self.to_date), v))
+            if self.value_type == VALUE_TYPE_REFKEY:
+                gen.remember(date_key, d)
+        return "%s(%s)" % (gen.const(self._eval), d)
+
     def _make_date(self, document):
         v = self.value
         if self.value_type == VALUE_TYPE_REFKEY:
             v = document.get(v)
         elif self.value_type == VALUE_TYPE_OPERATOR:
             v = v.eval(document)
+        return self.to_date(v)
 
+    def to_date(self, v):
         if isinstance(v, datetime):
             return v
         elif isinstance(v, date):
             return datetime(v.year, v.month, v.day)
         elif isNumberType(v):
-            return datetime.fromtimestamp(float(v))
+            return local_datetime(float(v))
         else:
             raise self.make_error("%s value must be date type" % self.name)
 
@@ -1126,6 +1783,28 @@ class ProjectMillisecondOperator(ProjectDateOperator):
         return d.microsecond // 1000
 
 
+class ProjectDateToPartsOperator(ProjectDateOperator):
+
+    name = "$dateToParts"
+    returnTypes = [types.DictType]
+
+    def __init__(self, key, value):
+        if isinstance(value, dict) and value.keys() == ["date"]:
+            value = value["date"]
+        super(ProjectDateToPartsOperator, self).__init__(key, value)
+
+    def _eval(self, d):
+        return {
+            "year": d.year,
+            "month": d.month,
+            "day": d.day,
+            "hour": d.hour,
+            "minute": d.minute,
+            "second": d.second,
+            "millisecond": d.microsecond // 1000,
+        }
+
+
 class ProjectCallOperator(ProjectOperator):
 
     name = "$call"
@@ -1136,9 +1815,15 @@ class ProjectCallOperator(ProjectOperator):
         if not callable(value):
             raise self.make_error("the $call operator requires callable")
 
+    def reads(self):
+        return set([ROOT])
+
     def eval(self, document):
         return self.value(document)
 
+    def compile(self, gen, doc):
+        return _compile_user_call(gen, "%s(%s)" % (gen.const(self.value), doc))
+
 
 class ProjectCondOperator(ProjectOperator):
 
@@ -1151,7 +1836,7 @@ class ProjectCondOperator(ProjectOperator):
             self.bool_op = OperatorFactory.new_project(key, self.value[0])
 
             if Value.is_doc_ref_key(self.value[1]):
-                self.value[1] = value[1:]
+                self.value[1] = self.value[1][1:]
                 self.true_type = VALUE_TYPE_REFKEY
             elif isinstance(self.value[1], dict):
                 self.value[1] = OperatorFactory.new_project(key, self.value[1])
@@ -1160,7 +1845,7 @@ class ProjectCondOperator(ProjectOperator):
                 self.true_type = VALUE_TYPE_PLAIN
 
             if Value.is_doc_ref_key(self.value[2]):
-                self.value[2] = value[1:]
+                self.value[2] = self.value[2][1:]
                 self.false_type = VALUE_TYPE_REFKEY
             elif isinstance(self.value[2], dict):
                 self.value[2] = OperatorFactory.new_project(key, self.value[2])
@@ -1170,6 +1855,13 @@ class ProjectCondOperator(ProjectOperator):
         else:
             raise self.make_error("the %cond operator requires an array of two elements")
 
+    def reads(self):
+        reads = set()
+        for v, vt in [(self.value[1], self.true_type), (self.value[2], self.false_type)]:
+            if vt == VALUE_TYPE_REFKEY and isinstance(v, basestring):
+                reads.add(v)
+        return reads
+
     def eval(self, document):
         if self.bool_op.project(document):
             if self.true_type == VALUE_TYPE_REFKEY:
@@ -1186,6 +1878,18 @@ class ProjectCondOperator(ProjectOperator):
             else:
                 return self.value[2]
 
+    def compile(self, gen, doc):
+        res = gen.var()
+        gen.emit("if %s:" % self.bool_op.compile(gen, doc))
+        gen.indent()
+        gen.emit("%s = %s" % (res, self.compile_operand(gen, doc, self.value[1], self.true_type)))
+        gen.dedent()
+        gen.emit("else:")
+        gen.indent()
+        gen.emit("%s = %s" % (res, self.compile_operand(gen, doc, self.value[2], self.false_type)))
+        gen.dedent()
+        return res
+
 
 class ProjectCombineOperator(ProjectOperator):
 
@@ -1208,16 +1912,47 @@ class ProjectCombineOperator(ProjectOperator):
                 pv[k] = v
         return pv
 
+    def compile(self, gen, doc):
+        pv = gen.assign("{}")
+        for k, combine_op in self.combined_ops:
+            v = _compile_guarded(gen, combine_op, doc, combine_op.project, combine_op)
+            gen.emit("if %s is not _undefined:" % v)
+            gen.indent()
+            gen.emit("%s[%r] = %s" % (pv, k, v))
+            gen.dedent()
+        return pv
+
 
 class GroupOperator(Operator):
+    """Accumulator of $group.
+
+    init_val returns state of a new group, eval folds one document into
+    the state and returns it, the state may be updated in place, result
+    converts the final state to output value.
+
+    operator which has mergeable True implements merge(acc_val, other),
+    which folds the state of same group accumulated from later documents
+    into acc_val, so groups can be accumulated in parts.
+    """
 
     command = "$group"
+    mergeable = False
 
     def __init__(self, key, value):
         self.key = key
         self.value = value
         self.value_type = VALUE_TYPE_PLAIN
 
+    def explain(self):
+        plan = super(GroupOperator, self).explain()
+        plan["mergeable"] = self.mergeable
+        return plan
+
+    def reads(self):
+        if self.value_type == VALUE_TYPE_REFKEY:
+            return set([self.value])
+        return set()
+
     def init_val(self):
         return undefined
 
@@ -1226,6 +1961,9 @@ class GroupOperator(Operator):
             return None
         return acc_val
 
+    def merge(self, acc_val, other):
+        raise self.make_error("%s accumulator can not be merged" % self.name)
+
     def group(self, document, acc_val):
         try:
             return self.eval(document, acc_val)
@@ -1243,18 +1981,28 @@ class GroupUnaryOperator(GroupOperator):
         if Value.is_doc_ref_key(value):
             self.value = value[1:]
             self.value_type = VALUE_TYPE_REFKEY
+            self.path = field_path(self.value)
         else:
             if isinstance(value, dict):
                 self.value = OperatorFactory.new_project(key, value)
                 self.value_type = VALUE_TYPE_OPERATOR
             elif isinstance(value, ArrayTypes):
                 raise self.make_error("aggregating group operators are unary (%s)" % self.name)
+        if self.value_type == VALUE_TYPE_OPERATOR:
+            self.value_eval = compile_expression(self.value, self.value.eval)
+
+    def interpret(self):
+        self.__dict__.pop("value_eval", None)
+        super(GroupUnaryOperator, self).interpret()
+
+    def value_eval(self, document):
+        return self.value.eval(document)
 
     def get_value(self, document, default=None):
         if self.value_type == VALUE_TYPE_REFKEY:
-            return document.get(self.value, default)
+            return self.path.get(document, default)
         elif self.value_type == VALUE_TYPE_OPERATOR:
-            v = self.value.eval(document)
+            v = self.value_eval(document)
             if v == undefined:
                 v = default
             return v
@@ -1265,6 +2013,7 @@ class GroupUnaryOperator(GroupOperator):
 class GroupSumOperator(GroupUnaryOperator):
 
     name = "$sum"
+    mergeable = True
 
     def init_val(self):
         return 0
@@ -1279,10 +2028,14 @@ class GroupSumOperator(GroupUnaryOperator):
         except Exception:
             return acc_val
 
+    def merge(self, acc_val, other):
+        return acc_val + other
+
 
 class GroupMinOperator(GroupUnaryOperator):
 
     name = "$min"
+    mergeable = True
 
     def eval(self, document, acc_val):
         value = self.get_value(document, undefined)
@@ -1293,10 +2046,16 @@ class GroupMinOperator(GroupUnaryOperator):
         else:
             return acc_val
 
+    def merge(self, acc_val, other):
+        if acc_val == undefined or other < acc_val:
+            return other
+        return acc_val
+
 
 class GroupMaxOperator(GroupUnaryOperator):
 
     name = "$max"
+    mergeable = True
 
     def eval(self, document, acc_val):
         value = self.get_value(document, undefined)
@@ -1307,28 +2066,46 @@ class GroupMaxOperator(GroupUnaryOperator):
         else:
             return acc_val
 
+    def merge(self, acc_val, other):
+        if acc_val == undefined or other > acc_val:
+            return other
+        return acc_val
+
 
 class GroupFirstOperator(GroupUnaryOperator):
 
     name = "$first"
+    mergeable = True
 
     def eval(self, document, acc_val):
         if acc_val == undefined:
             return self.get_value(document)
         return acc_val
 
+    def merge(self, acc_val, other):
+        if acc_val == undefined:
+            return other
+        return acc_val
+
 
 class GroupLastOperator(GroupUnaryOperator):
 
     name = "$last"
+    mergeable = True
 
     def eval(self, document, acc_val):
         return self.get_value(document)
 
+    def merge(self, acc_val, other):
+        if other == undefined:
+            return acc_val
+        return other
+
 
 class GroupAddToSetOperator(GroupUnaryOperator):
 
     name = "$addToSet"
+    mergeable = True
 
     def init_val(self):
         return set()
@@ -1342,10 +2119,15 @@ class GroupAddToSetOperator(GroupUnaryOperator):
             acc_val.add(value)
         return acc_val
 
+    def merge(self, acc_val, other):
+        acc_val.update(other)
+        return acc_val
+
 
 class GroupPushOperator(GroupUnaryOperator):
 
     name = "$push"
+    mergeable = True
 
     def init_val(self):
         return []
@@ -1359,42 +2141,38 @@ class GroupPushOperator(GroupUnaryOperator):
             acc_val.append(value)
         return acc_val
 
+    def merge(self, acc_val, other):
+        acc_val.extend(other)
+        return acc_val
 
-class GroupConcatToSetOperator(GroupUnaryOperator):
-
-    name = "$concatToSet"
 
-    def init_val(self):
-        return set()
+class GroupConcatToSetOperator(GroupAddToSetOperator):
 
-    def result(self, acc_val):
-        return list(acc_val)
+    name = "$concatToSet"
 
     def eval(self, document, acc_val):
         value = self.get_value(document, undefined)
         if value != undefined:
-            acc_val = acc_val | set(list(value))
+            acc_val.update(value)
         return acc_val
 
 
-class GroupConcatToListOperator(GroupUnaryOperator):
+class GroupConcatToListOperator(GroupPushOperator):
 
     name = "$concatToList"
 
-    def init_val(self):
-        return []
-
-    def result(self, acc_val):
-        return acc_val
-
     def eval(self, document, acc_val):
         value = self.get_value(document, undefined)
         if value != undefined:
-            acc_val = acc_val + list(value)
+            acc_val.extend(value)
         return acc_val
 
 
 class GroupCallOperator(GroupUnaryOperator):
+    """reducer(document, acc_val), the callable opts in the accumulator
+    protocol through attributes: init() returns initial state instead of
+    undefined, merge(acc_val, other) makes the operator mergeable.
+    """
 
     name = "$call"
 
@@ -1402,10 +2180,29 @@ class GroupCallOperator(GroupUnaryOperator):
         super(GroupCallOperator, self).__init__(key, value)
         if not callable(value):
             raise self.make_error("the $call operator requires callable")
+        self.mergeable = callable(getattr(value, "merge", None))
+
+    def reads(self):
+        return set([ROOT])
+
+    def init_val(self):
+        init = getattr(self.value, "init", None)
+        if callable(init):
+            return init()
+        return undefined
 
     def eval(self, document, acc_val):
         return self.value(document, acc_val)
 
+    def merge(self, acc_val, other):
+        if not self.mergeable:
+            return super(GroupCallOperator, self).merge(acc_val, other)
+        if acc_val == undefined:
+            return other
+        elif other == undefined:
+            return acc_val
+        return self.value.merge(acc_val, other)
+
 
 class GroupCombineOperator(GroupOperator):
 
@@ -1415,6 +2212,7 @@ class GroupCombineOperator(GroupOperator):
         for k, v in value.iteritems():
             combined_ops.append((k, OperatorFactory.new_group(k, v)))
         self.combined_ops = combined_ops
+        self.mergeable = all(combine_op.mergeable for k, combine_op in combined_ops)
 
     def init_val(self):
         doc = Document()
@@ -1431,3 +2229,8 @@ class GroupCombineOperator(GroupOperator):
         for k, combine_op in self.combined_ops:
             acc_val.set(k, combine_op.group(document, acc_val.get(k)))
         return acc_val
+
+    def merge(self, acc_val, other):
+        for k, combine_op in self.combined_ops:
+            acc_val.set(k, combine_op.merge(acc_val.get(k), other.get(k)))
+        return acc_val
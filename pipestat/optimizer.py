@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+from pipestat.utils import Value, isNumberType
+
+
+class Optimizer(object):
+    """Rewrite pipeline specification to an equivalent but cheaper one.
+
+    rules applied until nothing changes:
+        - drop no-op stages, like {"$match": {}}, {"$skip": 0}, {"$sort": []}
+        - merge adjacent $match, $skip and $limit stages
+        - move $match ahead of $project, $unwind, $sort when it only reads
+          fields those stages pass through unchanged
+        - move $skip/$limit ahead of $project, which is one to one
+
+    every applied rule is recorded in `actions`.
+
+    >>> optimizer = Optimizer()
+    >>> pipeline = optimizer.optimize([{"$project": {"app": 1}}, {"$limit": 3}])
+    """
+
+    def __init__(self):
+        self.actions = []
+
+    def optimize(self, pipeline):
+        pipeline = list(pipeline)
+        changed = True
+        while changed:
+            changed = False
+            for i, stage in enumerate(pipeline):
+                if len(pipeline) > 1 and self.is_noop(stage):
+                    self.actions.append("dropped no-op %s" % self._name(stage))
+                    del pipeline[i]
+                    changed = True
+                    break
+                if i + 1 >= len(pipeline):
+                    break
+                stages = self.rewrite(stage, pipeline[i+1])
+                if stages is not None:
+                    pipeline[i:i+2] = stages
+                    changed = True
+                    break
+        return pipeline
+
+    def is_noop(self, stage):
+        name, value = self._stage(stage)
+        if name == "$match":
+            return value == {}
+        elif name == "$skip":
+            return isNumberType(value) and int(value) <= 0
+        elif name == "$sort":
+            return isinstance(value, (dict, list, tuple)) and len(value) == 0
+        return False
+
+    def rewrite(self, stage, next_stage):
+        name, value = self._stage(stage)
+        next_name, next_value = self._stage(next_stage)
+        if name is None or next_name is None:
+            return None
+
+        if name == "$match" == next_name:
+            if not isinstance(value, dict) or not isinstance(next_value, dict):
+                return None
+            if set(value) & set(next_value):
+                merged = {"$and": [value, next_value]}
+            else:
+                merged = dict(value)
+                merged.update(next_value)
+            self.actions.append("merged adjacent $match stages")
+            return [{"$match": merged}]
+
+        if name == "$skip" == next_name:
+            if isNumberType(value) and isNumberType(next_value):
+                self.actions.append("merged adjacent $skip stages")
+                # negative $skip skips nothing
+                return [{"$skip": max(int(value), 0) + max(int(next_value), 0)}]
+            return None
+
+        if name == "$limit" == next_name:
+            if isNumberType(value) and isNumberType(next_value):
+                self.actions.append("merged adjacent $limit stages")
+                return [{"$limit": min(int(value), int(next_value))}]
+            return None
+
+        if next_name == "$match" and name in ["$project", "$unwind", "$sort"]:
+            fields = match_fields(next_value)
+            if fields is None:
+                return None
+            if name == "$project" and not project_passes(value, fields):
+                return None
+            if name == "$unwind" and not unwind_passes(value, fields):
+                return None
+            self.actions.append("moved $match ahead of %s" % name)
+            return [next_stage, stage]
+
+        if next_name in ["$skip", "$limit"] and name == "$project":
+            self.actions.append("moved %s ahead of $project" % next_name)
+            return [next_stage, stage]
+
+        return None
+
+    def _stage(self, stage):
+        if isinstance(stage, dict) and len(stage) == 1:
+            return stage.items()[0]
+        return None, None
+
+    def _name(self, stage):
+        return self._stage(stage)[0]
+
+
+def match_fields(spec):
+    """fields read by $match specification, None if unknown"""
+    if not isinstance(spec, dict):
+        return None
+    fields = set()
+    for k, v in spec.iteritems():
+        if k in ["$and", "$or", "$nor"]:
+            if not isinstance(v, list):
+                return None
+            for sub_spec in v:
+                sub_fields = match_fields(sub_spec)
+                if sub_fields is None:
+                    return None
+                fields |= sub_fields
+        elif Value.is_operator(k):
+            return None
+        else:
+            fields.add(k)
+    return fields
+
+
+def _path_covers(path, field):
+    return field == path or field.startswith(path + ".")
+
+
+def _path_overlaps(path, field):
+    return _path_covers(path, field) or _path_covers(field, path)
+
+
+def project_passes(spec, fields):
+    """whether all fields keep same value after $project specification"""
+    if not isinstance(spec, dict) or not spec:
+        return False
+    values = spec.values()
+    if all(v == 0 for v in values):
+        return all(f.split(".")[0] not in spec for f in fields)
+
+    passes = [k for k, v in spec.iteritems() if v == 1 or v == "$" + k]
+    others = [k for k in spec if k not in passes]
+    for f in fields:
+        if not any(_path_covers(k, f) for k in passes):
+            return False
+        # a computed field inside the passed one overwrites part of it
+        if any(_path_overlaps(k, f) for k in others):
+            return False
+    return True
+
+
+def unwind_passes(spec, fields):
+    """whether all fields keep same value after $unwind specification"""
+    if not Value.is_doc_ref_key(spec):
+        return False
+    return not any(_path_overlaps(spec[1:], f) for f in fields)
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+
+import Queue
+import itertools
+import threading
+import multiprocessing
+from pipestat.api import pipestat, batches, BATCH_SIZE
+from pipestat.commands import Command, MatchCommand, ProjectCommand, UnwindCommand, GroupCommand
+from pipestat.commands import SortCommand, SortLimitCommand, feed_chunks
+from pipestat.errors import PipelineError, LimitCompleted
+from pipestat.models import Document
+from pipestat.pipeline import Pipeline
+from pipestat.utils import group_key
+
+
+# commands which work on every document alone
+PER_DOCUMENT_COMMANDS = (MatchCommand, ProjectCommand, UnwindCommand)
+
+# seconds to wait on a queue before checking worker processes are alive
+POLL_TIMEOUT = 0.5
+
+
+def pipestat_parallel(sources, pipeline, workers=None, batch_size=BATCH_SIZE):
+    """stat many sources with worker processes.
+
+    every worker runs the leading $match/$project/$unwind commands and a
+    following $group on whole sources, the parent merges the partial
+    group tables in order of sources and runs the remaining commands.
+    pipeline which cannot be split is run in the parent process.
+
+    a source is an iterable of documents, or a callable returning it
+    which is called in the worker, sources are passed to the workers as
+    process arguments. a worker which dies raises PipelineError.
+
+    >>> sources = [functools.partial(load_log, path) for path in paths]
+    >>> pipestat_parallel(sources, pipeline, workers=4)
+    """
+    p = Pipeline(pipeline)
+    commands = list(p.commands())
+    split = split_index(commands)
+    if split == 0:
+        dataset = itertools.chain.from_iterable(_load(source) for source in sources)
+        return pipestat(dataset, pipeline, batch_size=batch_size)
+
+    spec = p.pipeline[:split]
+    if workers == 1:
+        _init_worker(spec, batch_size)
+        partials = itertools.imap(_run_partial, sources)
+        return _merge_partials(commands, split, partials)
+
+    workers = workers or multiprocessing.cpu_count()
+    sources = list(sources)
+    tasks = multiprocessing.Queue()
+    for i in range(len(sources)):
+        tasks.put(i)
+    results = multiprocessing.Queue()
+    processes = []
+    try:
+        for i in range(workers):
+            tasks.put(None)
+            process = multiprocessing.Process(target=_run_partials,
+                                              args=(spec, batch_size, sources, tasks, results))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+        partials = _ordered_partials(results, len(sources), processes)
+        return _merge_partials(commands, split, partials)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def _ordered_partials(results, n, processes):
+    """partial results of workers in order of sources"""
+    partials = {}
+    for i in range(n):
+        while i not in partials:
+            j, partial, error = _get_output(results, processes)
+            if error is not None:
+                raise error
+            partials[j] = partial
+        yield partials.pop(i)
+
+
+def pipestat_partitioned(dataset, pipeline, workers=None, batch_size=BATCH_SIZE):
+    """stat dataset with the $group table partitioned to worker processes.
+
+    the parent runs the leading $match/$project/$unwind commands and routes
+    documents by hash of the computed _id, so every worker owns a disjoint
+    part of groups and any accumulator works, mergeable or not. workers
+    run the $group with the following per-document commands and $sort,
+    the parent merges sorted outputs of workers and runs the remaining
+    commands. pipeline without such $group is run in the parent process.
+
+    >>> pipestat_partitioned(dataset, pipeline, workers=4)
+    """
+    p = Pipeline(pipeline)
+    commands = list(p.commands())
+    start = partition_index(commands)
+    if start is None:
+        return pipestat(dataset, pipeline, batch_size=batch_size)
+
+    end = start + 1
+    while end < len(commands) and isinstance(commands[end], PER_DOCUMENT_COMMANDS):
+        end += 1
+    sort = None
+    if end < len(commands) and isinstance(commands[end], SortCommand):
+        sort = commands[end]
+        end += 1
+    spec = p.pipeline[start:end]
+    if isinstance(sort, SortLimitCommand):
+        spec.append({"$limit": sort.limit})
+
+    workers = workers or multiprocessing.cpu_count()
+    results = multiprocessing.Queue()
+    queues = []
+    processes = []
+    try:
+        for i in range(workers):
+            queue = multiprocessing.Queue(4)
+            process = multiprocessing.Process(target=_run_shard, args=(spec, i, queue, results))
+            process.daemon = True
+            process.start()
+            queues.append(queue)
+            processes.append(process)
+
+        router = PartitionCommand(commands[start], queues, batch_size, processes)
+        head = router
+        if start > 0:
+            commands[start-1].next = router
+            head = commands[0]
+        for items in batches(dataset, batch_size):
+            feed_chunks(head, [Document(item) for item in items])
+        head.result()
+
+        shards = [None] * workers
+        pending = dict(enumerate(processes))
+        while pending:
+            i, documents, error = _get_result(results, pending)
+            if error is not None:
+                raise error
+            shards[i] = documents
+            del pending[i]
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    if sort is not None:
+        documents = sort.merge_runs(shards)
+    else:
+        documents = itertools.chain.from_iterable(shards)
+    if end == len(commands):
+        return list(documents)
+    cmd = commands[end]
+    try:
+        for items in batches(documents, batch_size):
+            feed_chunks(cmd, items)
+    except LimitCompleted:
+        pass
+    return cmd.result()
+
+
+class PartitionCommand(Command):
+    """Route documents to queues by hash of the _id of a $group,
+    documents of one group always go to the same queue.
+    """
+
+    def __init__(self, group, queues, batch_size, processes):
+        super(PartitionCommand, self).__init__(None)
+        self.group = group
+        self.queues = queues
+        self.batch_size = batch_size
+        self.processes = processes
+        self.buffers = [[] for queue in queues]
+
+    def feed(self, document):
+        self.feed_batch([document])
+
+    def feed_batch(self, documents):
+        gen_id = self.group.gen_id
+        n = len(self.queues)
+        for document in documents:
+            ids = gen_id(document)
+            try:
+                h = hash(ids)
+            except TypeError:
+                h = hash(group_key(ids))
+            i = h % n
+            buf = self.buffers[i]
+            buf.append(document)
+            if len(buf) >= self.batch_size:
+                self.put(i, buf)
+                self.buffers[i] = []
+
+    def put(self, i, item):
+        while True:
+            try:
+                self.queues[i].put(item, timeout=POLL_TIMEOUT)
+                return
+            except Queue.Full:
+                if not self.processes[i].is_alive():
+                    raise _worker_error(self.processes[i])
+
+    def result(self):
+        for i, buf in enumerate(self.buffers):
+            if buf:
+                self.put(i, buf)
+            self.put(i, None)
+        self.buffers = [[] for queue in self.queues]
+        return []
+
+
+def _get_result(results, processes):
+    """next result of worker processes, raise if one of `processes`
+    exited without a result.
+    """
+    while True:
+        try:
+            return results.get(timeout=POLL_TIMEOUT)
+        except Queue.Empty:
+            dead = [process for process in processes.itervalues() if not process.is_alive()]
+            if dead:
+                # result put before exit may arrive right after the timeout
+                try:
+                    return results.get(timeout=POLL_TIMEOUT)
+                except Queue.Empty:
+                    raise _worker_error(dead[0])
+
+
+def _worker_error(process):
+    return PipelineError("worker process %s exited unexpectedly with code %s" % (process.name, process.exitcode))
+
+
+def pipestat_pipelined(dataset, pipeline, splits=None, batch_size=BATCH_SIZE, queue_size=4):
+    """stat dataset with commands run in a chain of worker processes.
+
+    commands are split into segments before indexes in `splits`, which
+    refer to stages of Pipeline(pipeline).explain(), every command runs
+    in its own process by default. a $sort is never split from the
+    $skip, $limit or $group following it, which are fused with it.
+    segments are connected by queues of at most `queue_size` batches,
+    so a slow segment blocks the ones before it instead of buffering
+    documents. an error of any segment stops reading dataset.
+
+    >>> pipestat_pipelined(dataset, pipeline, splits=[1, 2])
+    """
+    spec = Pipeline(pipeline).pipeline
+    if splits is None:
+        splits = range(1, len(spec))
+    bounds = [0] + sorted(set(i for i in splits if 0 < i < len(spec) and not _fused_at(spec, i))) + [len(spec)]
+
+    stop = multiprocessing.Event()
+    queues = [multiprocessing.Queue(queue_size) for i in bounds]
+    processes = []
+    errors = []
+    try:
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            process = multiprocessing.Process(target=_run_stage,
+                                              args=(spec[start:end], queues[i], queues[i+1], stop))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        feeder = threading.Thread(target=_feed_stages,
+                                  args=(dataset, batch_size, queues[0], processes[0], stop, errors))
+        feeder.daemon = True
+        feeder.start()
+
+        documents = []
+        while True:
+            items = _get_output(queues[-1], processes)
+            if items is None:
+                break
+            if isinstance(items, Exception):
+                errors.append(items)
+            else:
+                documents.extend(items)
+        feeder.join()
+    finally:
+        stop.set()
+        for process in processes:
+            process.terminate()
+            process.join()
+    if errors:
+        raise errors[0]
+    return documents
+
+
+def _fused_at(spec, i):
+    """whether spec[i] may be fused with the $sort before it"""
+    names = [p.keys()[0] if isinstance(p, dict) and len(p) == 1 else None for p in spec[max(i-2, 0):i+1]]
+    if names[-2:] in (["$sort", "$skip"], ["$sort", "$limit"], ["$sort", "$group"]):
+        return True
+    return names == ["$sort", "$skip", "$limit"]
+
+
+def _get_output(queue, processes):
+    """next item of queue, raise if one of `processes` exited abnormally,
+    they exit with code 0 after their last output.
+    """
+    while True:
+        try:
+            return queue.get(timeout=POLL_TIMEOUT)
+        except Queue.Empty:
+            dead = [process for process in processes if not process.is_alive() and process.exitcode != 0]
+            if dead:
+                raise _worker_error(dead[0])
+
+
+def _feed_stages(dataset, batch_size, queue, process, stop, errors):
+    try:
+        for items in batches(dataset, batch_size):
+            if stop.is_set():
+                break
+            if not _put_stage(queue, items, process):
+                return
+    except Exception, e:
+        errors.append(e)
+    finally:
+        _put_stage(queue, None, process)
+
+
+def _put_stage(queue, item, process):
+    """put item to the input queue of process, False if it is dead"""
+    while True:
+        try:
+            queue.put(item, timeout=POLL_TIMEOUT)
+            return True
+        except Queue.Full:
+            if not process.is_alive():
+                return False
+
+
+def _run_stage(spec, inqueue, outqueue, stop):
+    error = None
+    try:
+        p = Pipeline(spec, optimize=False)
+    except Exception, e:
+        error = e
+        stop.set()
+    # errors are passed downstream and stop reading dataset, input is
+    # still read till the end, or the segments before may block on the
+    # full queue
+    for items in iter(inqueue.get, None):
+        if error is None and isinstance(items, Exception):
+            error = items
+        if error is not None:
+            continue
+        try:
+            documents = p.push(items)
+            if documents:
+                outqueue.put(documents)
+            if p.completed:
+                stop.set()
+        except Exception, e:
+            error = e
+            stop.set()
+    if error is None:
+        try:
+            documents = p.result()
+            if documents:
+                outqueue.put(documents)
+        except Exception, e:
+            error = e
+    if error is not None:
+        outqueue.put(error)
+    outqueue.put(None)
+
+
+def partition_index(commands):
+    """index of the $group after leading per-document commands, None if
+    there is no such one.
+    """
+    for i, cmd in enumerate(commands):
+        if isinstance(cmd, GroupCommand):
+            return i
+        elif not isinstance(cmd, PER_DOCUMENT_COMMANDS):
+            return None
+    return None
+
+
+def split_index(commands):
+    """number of leading commands which can run in the workers"""
+    for i, cmd in enumerate(commands):
+        if isinstance(cmd, GroupCommand):
+            return i + 1 if cmd.mergeable else i
+        elif not isinstance(cmd, PER_DOCUMENT_COMMANDS):
+            return i
+    return len(commands)
+
+
+def _merge_partials(commands, split, partials):
+    last = commands[split-1]
+    if isinstance(last, GroupCommand):
+        for ids, columns in partials:
+            last.merge_state(ids, columns)
+        return last.result()
+
+    if split == len(commands):
+        documents = []
+        for partial in partials:
+            documents.extend(partial)
+        return documents
+
+    cmd = commands[split]
+    try:
+        for partial in partials:
+            feed_chunks(cmd, partial)
+    except LimitCompleted:
+        pass
+    return cmd.result()
+
+
+def _load(source):
+    if callable(source):
+        return source()
+    return source
+
+
+_worker = {}
+
+
+def _init_worker(spec, batch_size):
+    _worker["spec"] = spec
+    _worker["batch_size"] = batch_size
+
+
+def _run_shard(spec, i, queue, results):
+    documents, error = None, None
+    try:
+        p = Pipeline(spec, optimize=False)
+        for items in iter(queue.get, None):
+            p.feed_many(items)
+    except Exception, e:
+        error = e
+        # keep reading, or the parent may block on the full queue
+        for items in iter(queue.get, None):
+            pass
+    else:
+        try:
+            documents = p.result()
+        except Exception, e:
+            error = e
+    results.put((i, documents, error))
+
+
+def _run_partials(spec, batch_size, sources, tasks, results):
+    _init_worker(spec, batch_size)
+    for i in iter(tasks.get, None):
+        try:
+            results.put((i, _run_partial(sources[i]), None))
+        except Exception, e:
+            results.put((i, None, e))
+
+
+def _run_partial(source):
+    p = Pipeline(_worker["spec"], optimize=False)
+    for items in batches(_load(source), _worker["batch_size"]):
+        p.feed_many(items)
+    last = list(p.commands())[-1]
+    if isinstance(last, GroupCommand):
+        return last.state()
+    return p.result()
@@ -1,30 +1,140 @@
 # -*- coding: utf-8 -*-
 
 import copy
-from pipestat.commands import CommandFactory
-from pipestat.errors import PipelineError
+from pipestat.commands import CommandFactory, GroupCommand, SortedGroupCommand, feed_chunks
+from pipestat.commands import SortCommand, SortLimitCommand, SkipCommand, LimitCommand
+from pipestat.errors import PipelineError, LimitCompleted
+from pipestat.constants import BATCH_SIZE
 from pipestat.models import Document
+from pipestat.optimizer import Optimizer
+from pipestat.profiler import Profiler
+from pipestat.utils import batches
 
 
 class Pipeline(object):
 
-    def __init__(self, pipeline):
+    def __init__(self, pipeline, optimize=True, profile=False, buffer_size=None, presorted=False):
         pipeline = copy.deepcopy(pipeline)
-        self.cmd = None
-        prev_cmd = None
-        for p in pipeline:
-            cmd = CommandFactory.new(p)
-            if prev_cmd:
-                prev_cmd.next = cmd
-            else:
-                self.cmd = cmd
-            prev_cmd = cmd
-
-        if not self.cmd:
+        self.optimizer = Optimizer()
+        if optimize and isinstance(pipeline, (list, tuple)):
+            pipeline = self.optimizer.optimize(pipeline)
+        # commands may change specification in place
+        self.pipeline = copy.deepcopy(pipeline)
+        commands = [CommandFactory.new(p) for p in pipeline]
+        if not commands:
             raise PipelineError('pipeline specification must be an array of at least one command')
 
+        self.actions = list(self.optimizer.actions)
+        # documents reaching the first $group are ordered by its _id
+        self.presorted = presorted
+        commands = self.fuse(commands)
+        for prev_cmd, cmd in zip(commands, commands[1:]):
+            prev_cmd.next = cmd
+        for cmd in commands:
+            if isinstance(cmd, (SortCommand, GroupCommand)):
+                cmd.buffer_size = buffer_size
+        self.cmd = commands[0]
+        self.profiler = Profiler(commands) if profile else None
+        # whether a $limit has passed all its documents, see push
+        self.completed = False
+
+    def commands(self):
+        cmd = self.cmd
+        while cmd:
+            yield cmd
+            cmd = cmd.next
+
+    def explain(self):
+        """physical plan which will actually run.
+
+        `actions` lists specification rewrites and command fusions,
+        `stages` lists every command with its operator tree and the
+        fields it reads and writes.
+        """
+        return {
+            "actions": list(self.actions),
+            "stages": [cmd.explain() for cmd in self.commands()],
+        }
+
+    def fuse(self, commands):
+        """replace command with faster one which has same result in the chain"""
+        fused = []
+        presorted = self.presorted
+        for i, cmd in enumerate(commands):
+            if type(cmd) is SortCommand:
+                limit = self._sort_limit(commands[i+1:])
+                if limit is not None:
+                    cmd = SortLimitCommand(cmd.value, limit)
+                    self.actions.append("fused $sort with following $limit, keep %d documents" % limit)
+            elif type(cmd) is GroupCommand:
+                action = None
+                if presorted:
+                    action = "grouped presorted input as it comes"
+                elif fused and isinstance(fused[-1], SortCommand) and \
+                        cmd.sorted_by([k for k, direction in fused[-1].value]):
+                    action = "grouped output of $sort on _id as it comes"
+                if action:
+                    cmd = SortedGroupCommand(copy.deepcopy(self.pipeline[i]["$group"]))
+                    self.actions.append(action)
+                presorted = False
+            fused.append(cmd)
+        return fused
+
+    def _sort_limit(self, commands):
+        skip = 0
+        if commands and isinstance(commands[0], SkipCommand):
+            skip = max(commands[0].value, 0)
+            commands = commands[1:]
+        if commands and isinstance(commands[0], LimitCommand):
+            return skip + commands[0].value
+        return None
+
     def feed(self, item):
         self.cmd.feed(Document(item))
 
+    def feed_many(self, items):
+        feed_chunks(self.cmd, [Document(item) for item in items])
+
     def result(self):
         return self.cmd.result()
+
+    def push(self, items):
+        """feed a batch of items and return documents which passed the
+        last command meanwhile, the rest is returned by result().
+
+        it never blocks on input, so items can be pushed piece by piece
+        as they arrive, from an event loop callback or an executor, but
+        only one batch at a time. once `completed` is set by a $limit,
+        pushed items are ignored.
+        """
+        if not self.completed:
+            try:
+                self.feed_many(items)
+            except LimitCompleted:
+                self.completed = True
+        tail = list(self.commands())[-1]
+        documents, tail.documents = tail.documents, []
+        if self.profiler:
+            self.profiler.add_out(len(documents))
+        return documents
+
+    def stream(self, dataset, batch_size=BATCH_SIZE):
+        """feed dataset and yield result documents as soon as they pass
+        the last command, documents held by $sort or $group are yielded
+        after the whole dataset is fed.
+        """
+        for items in batches(dataset, batch_size):
+            for doc in self.push(items):
+                yield doc
+            if self.completed:
+                break
+        for doc in self.result():
+            yield doc
+
+    def stats(self):
+        """runtime counters of every command and operator,
+        only available when pipeline created with profile=True.
+        """
+        if not self.profiler:
+            raise PipelineError("pipeline profile is not enabled")
+        return self.profiler.report()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from timeit import default_timer
+from pipestat.errors import LimitCompleted
+from pipestat.models import undefined
+from pipestat.operator import MatchOperator, ProjectOperator, GroupOperator
+
+
+class Profiler(object):
+    """Count documents, wall time and exceptions of commands and operators.
+
+    instrument wraps the entry methods on command and operator instances,
+    so it costs nothing unless enabled: Pipeline(pipeline, profile=True).
+    profiled commands evaluate operators one by one instead of the
+    compiled code, so every operator gets its counters.
+
+    time of a command excludes the time spent in the downstream commands,
+    time of an operator includes its operands.
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.stages = []
+        for cmd in commands:
+            self.stages.append(self.instrument_command(cmd))
+
+    def instrument_command(self, cmd):
+        cmd.interpret()
+        stats = _new_stats()
+        stats["command"] = cmd.name
+        stats["class"] = type(cmd).__name__
+        stats["operators"] = [self.instrument_operator(op, k) for k, op in _command_operators(cmd)]
+
+        feed = cmd.feed
+        feed_batch = cmd.feed_batch
+        result = cmd.result
+
+        def profiled_feed(document):
+            stats["in"] += 1
+            _call(stats, feed, document)
+
+        def profiled_feed_batch(documents):
+            stats["in"] += len(documents)
+            _call(stats, feed_batch, documents)
+
+        def profiled_result():
+            documents = _call(stats, result)
+            if cmd.next is None:
+                stats["out"] += len(documents)
+            return documents
+
+        cmd.feed = profiled_feed
+        cmd.feed_batch = profiled_feed_batch
+        cmd.result = profiled_result
+        return stats
+
+    def instrument_operator(self, op, key=None):
+        stats = _new_stats()
+        stats["operator"] = getattr(op, "name", None)
+        stats["class"] = type(op).__name__
+        if key is not None:
+            stats["field"] = key
+        stats["operands"] = [self.instrument_operator(sub_op) for sub_op in op.operands()]
+
+        if isinstance(op, MatchOperator):
+            method, is_out = "match", bool
+        elif isinstance(op, ProjectOperator):
+            method, is_out = "eval", lambda v: v is not undefined
+        elif isinstance(op, GroupOperator):
+            method, is_out = "group", lambda v: True
+        else:
+            return stats
+        func = getattr(op, method)
+
+        def profiled(*args):
+            stats["in"] += 1
+            v = _call(stats, func, *args)
+            if is_out(v):
+                stats["out"] += 1
+            return v
+
+        setattr(op, method, profiled)
+        return stats
+
+    def add_out(self, count):
+        """count documents taken from the last command before result"""
+        if self.stages:
+            self.stages[-1]["out"] += count
+
+    def report(self):
+        """profile counters as dict, time in seconds"""
+        stages = []
+        for i, stats in enumerate(self.stages):
+            stage = dict(stats)
+            if i + 1 < len(self.stages):
+                downstream = self.stages[i+1]
+                stage["out"] = downstream["in"]
+                stage["time"] = stats["time"] - downstream["time"]
+            stages.append(stage)
+        return {
+            "time": self.stages[0]["time"] if self.stages else 0.0,
+            "stages": stages,
+        }
+
+
+def _new_stats():
+    return {"in": 0, "out": 0, "time": 0.0, "errors": 0}
+
+
+def _call(stats, func, *args):
+    start = default_timer()
+    try:
+        return func(*args)
+    except LimitCompleted:
+        raise
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        stats["time"] += default_timer() - start
+
+
+def _command_operators(cmd):
+    operators = getattr(cmd, "operators", [])
+    operators = [op if isinstance(op, tuple) else (None, op) for op in operators]
+    _id = getattr(cmd, "_id", None)
+    if hasattr(_id, "operands"):
+        operators.insert(0, ("_id", _id))
+    return operators
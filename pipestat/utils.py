@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import re
+import time
+import calendar
+import itertools
+import sre_parse
+import sre_constants
+from datetime import datetime
 from pipestat.constants import NumberTypes, DateTypes
 
 
@@ -25,8 +32,283 @@ class Value(object):
             return False
 
 
+def required_literal(regex):
+    """longest ascii substring every match of compiled regex contains,
+    None if there is no such one of at least two characters.
+
+    checking it with `in` is much cheaper than a search, and a string
+    without it can not match.
+    """
+    pattern = getattr(regex, "pattern", None)
+    flags = getattr(regex, "flags", None)
+    if not isinstance(pattern, basestring) or flags is None or flags & re.IGNORECASE:
+        return None
+    try:
+        items = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    literals = _required_literals(items)
+    if literals:
+        literal = max(literals, key=len)
+        if len(literal) >= 2:
+            return literal
+    return None
+
+
+def _required_literals(items):
+    literals = []
+    run = []
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append("".join(run))
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            literals.extend(_required_literals(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            literals.extend(_required_literals(av[2]))
+    if run:
+        literals.append("".join(run))
+    return literals
+
+
+# python 2 re supports at most 100 groups in one pattern
+MAX_REGEX_GROUPS = 99
+
+
+def union_regex(regexes):
+    """compiled regexes searching a string as one alternation, the search
+    of any of them matches iff one of given regexes matches.
+
+    regexes with same flags are joined, those with group references,
+    verbose flag or which are not compiled patterns are left alone.
+    """
+    unions = []
+    chunks = {}
+    for regex in regexes:
+        pattern = getattr(regex, "pattern", None)
+        flags = getattr(regex, "flags", None)
+        if not isinstance(pattern, basestring) or flags is None or \
+                flags & re.VERBOSE or regex.groups > MAX_REGEX_GROUPS:
+            unions.append(regex)
+            continue
+        try:
+            if _has_groupref(sre_parse.parse(pattern, flags)):
+                unions.append(regex)
+                continue
+        except Exception:
+            unions.append(regex)
+            continue
+        chunk = chunks.get(flags)
+        if chunk is None or sum(r.groups for r in chunk) + regex.groups > MAX_REGEX_GROUPS:
+            chunk = chunks[flags] = []
+            unions.append(chunk)
+        chunk.append(regex)
+
+    for i, chunk in enumerate(unions):
+        if isinstance(chunk, list) and len(chunk) > 1:
+            try:
+                pattern = "|".join("(?:%s)" % r.pattern for r in chunk)
+                unions[i] = re.compile(pattern, chunk[0].flags)
+            except Exception:
+                # like duplicate group names, keep them alone
+                pass
+    return list(_flatten(unions))
+
+
+def _has_groupref(items):
+    for op, av in items:
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+        for sub_items in _sub_patterns(av):
+            if _has_groupref(sub_items):
+                return True
+    return False
+
+
+def _sub_patterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for v in av:
+            for sub_items in _sub_patterns(v):
+                yield sub_items
+
+
+def _flatten(items):
+    for item in items:
+        if isinstance(item, list):
+            for v in item:
+                yield v
+        else:
+            yield item
+
+
+def batches(dataset, batch_size):
+    it = iter(dataset)
+    while True:
+        items = list(itertools.islice(it, batch_size))
+        if not items:
+            break
+        yield items
+
+
 def isNumberType(val):
     return isinstance(val, NumberTypes)
 
 def isDateType(val):
     return isinstance(val, DateTypes)
+
+
+class _KeyTag(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return self.name
+
+_dict_tag = _KeyTag("_dict_tag")
+_list_tag = _KeyTag("_list_tag")
+_set_tag = _KeyTag("_set_tag")
+
+
+def group_key(val):
+    """canonical hashable key of val, equal values get equal keys.
+
+    dicts and arrays are converted to tagged tuples recursively, so a key
+    never equals one of a hashable value of different type.
+    """
+    if isinstance(val, dict):
+        return (_dict_tag, tuple(sorted((k, group_key(v)) for k, v in val.iteritems())))
+    elif isinstance(val, (list, tuple)):
+        return (_list_tag, tuple(group_key(v) for v in val))
+    elif isinstance(val, (set, frozenset)):
+        return (_set_tag, frozenset(val))
+    return val
+
+
+class TimestampParser(object):
+    """time.mktime(time.strptime(v, format)) with a fast path.
+
+    formats of %Y %m %d %H %M %S in this order between literal separators,
+    with an optional %f, like "%Y-%m-%d %H:%M:%S,%f" or "%Y-%m-%dT%H:%M:%SZ",
+    are matched by one regex and the epoch of the date/hour prefix is
+    cached. values the fast path does not take go to strptime, so results
+    and errors are the same, milliseconds are dropped by both.
+
+    >>> TimestampParser("%Y-%m-%d %H:%M:%S").parse("2014-01-02 03:04:05")
+    """
+
+    def __init__(self, format):
+        self.format = format
+        self.regex = _timestamp_regex(format)
+        self.hours = {}
+        if self.regex is None:
+            self.parse = self._parse_slow
+        else:
+            self.parse = self._parse_fast
+
+    def _parse_slow(self, v):
+        return time.mktime(time.strptime(v, self.format))
+
+    def _parse_fast(self, v):
+        m = self.regex.match(v)
+        if m is None:
+            return self._parse_slow(v)
+        prefix = v[:m.end(4)]
+        try:
+            base = self.hours[prefix]
+        except KeyError:
+            if len(self.hours) > 10000:
+                self.hours.clear()
+            base = self.hours[prefix] = _hour_epoch(*map(int, m.group(1, 2, 3, 4)))
+        minute, second = int(m.group(5)), int(m.group(6))
+        if base is None or minute > 59 or second > 59:
+            return self._parse_slow(v)
+        return base + minute * 60 + second
+
+
+_timestamp_fields = "YmdHMS"
+
+
+def _timestamp_regex(format):
+    parts = []
+    fields = []
+    i = 0
+    while i < len(format):
+        c = format[i]
+        if c == "%":
+            directive = format[i+1:i+2]
+            if directive == "Y":
+                parts.append(r"(\d\d\d\d)")
+            elif directive and directive in _timestamp_fields:
+                parts.append(r"(\d\d)")
+            elif directive == "f" and fields[-1:] == ["S"]:
+                parts.append(r"\d{1,6}")
+            else:
+                return None
+            fields.append(directive)
+            i += 2
+        elif c.isdigit():
+            return None
+        else:
+            parts.append(re.escape(c))
+            i += 1
+    if [f for f in fields if f != "f"] != list(_timestamp_fields):
+        return None
+    return re.compile("".join(parts) + r"\Z")
+
+
+def _hour_epoch(year, month, day, hour):
+    """epoch of local hour, None unless every second of it follows"""
+    if year < 1900 or not 1 <= month <= 12 or hour > 23 or \
+            not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    try:
+        start = time.mktime((year, month, day, hour, 0, 0, 0, 0, -1))
+        end = time.mktime((year, month, day, hour, 59, 59, 0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+    if end - start != 3599:
+        # local time skips inside the hour
+        return None
+    hour = (year, month, day, hour)
+    if time.localtime(start)[:4] != hour or time.localtime(start - 3600)[:4] == hour or \
+            time.localtime(start + 3600)[:4] == hour:
+        # hour which does not exist or is repeated on daylight saving change
+        return None
+    return start
+
+
+_utc_offsets = {}
+
+
+def local_datetime(timestamp):
+    """datetime.fromtimestamp(timestamp), the utc offset is looked up
+    once per hour since epoch.
+    """
+    hour = timestamp // 3600
+    try:
+        offset = _utc_offsets[hour]
+    except KeyError:
+        if len(_utc_offsets) > 10000:
+            _utc_offsets.clear()
+        offset = _utc_offsets[hour] = _utc_offset(hour * 3600)
+    if offset is None:
+        return datetime.fromtimestamp(timestamp)
+    return datetime.utcfromtimestamp(timestamp) + offset
+
+
+def _utc_offset(start):
+    """utc offset of local time in the hour from start, None if it changes"""
+    try:
+        offset = datetime.fromtimestamp(start) - datetime.utcfromtimestamp(start)
+        end = start + 3599
+        if datetime.fromtimestamp(end) - datetime.utcfromtimestamp(end) != offset:
+            return None
+    except (ValueError, OverflowError):
+        return None
+    return offset
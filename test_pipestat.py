@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import re
+import itertools
 import unittest
 import datetime
 from pipestat.models import Document, undefined
 from pipestat.commands import (
     MatchCommand, ProjectCommand, GroupCommand,
-    SortCommand, SkipCommand, LimitCommand, UnwindCommand
+    SortCommand, SkipCommand, LimitCommand, UnwindCommand,
+    SortLimitCommand, SortedGroupCommand
 )
-from pipestat.errors import PipelineError, OperatorError, CommandError
-from pipestat import pipestat
+from pipestat.errors import PipelineError, OperatorError, CommandError, LimitCompleted
+from pipestat.optimizer import Optimizer
+from pipestat.operator import OperatorFactory
+from pipestat import pipestat, pipestat_iter, pipestat_parallel, pipestat_partitioned, pipestat_pipelined, Pipeline
 
 
 
@@ -33,6 +38,17 @@ class DocumentTest(unittest.TestCase):
         }
         self.assertEqual(Document(doc).get("address.ips.ip"), [["192.168.198.1", "192.168.198.2"]])
 
+    def test_path(self):
+        doc = Document({"a": {"b": {"c": 1}}, "l": [{"x": 1}, {"y": 2}, {"x": 3}], "s": "str"})
+        self.assertEqual(doc.get("a"), {"b": {"c": 1}})
+        self.assertEqual(doc.get("a.b"), {"c": 1})
+        self.assertEqual(doc.get("a.b.c"), 1)
+        self.assertEqual(doc.get("a.b.d", 0), 0)
+        self.assertEqual(doc.get("l.x"), [1, 3])
+        self.assertEqual(doc.get("s.x"), None)
+        self.assertEqual(doc.get(None, 5), 5)
+        self.assertEqual(doc.get("a.b.c"), 1)
+
 class MatchCommandTest(unittest.TestCase):
 
     def test_exists(self):
@@ -65,6 +81,72 @@ class MatchCommandTest(unittest.TestCase):
             Document({"app": "app2", "elapse": 3}),
         ])
 
+    def test_regexp_literal(self):
+        from pipestat.utils import required_literal
+        for pattern, literal in [
+            ("GET /api/(\w+)", "GET /api/"), ("(?:foo)+bar", "foo"), ("x?yz", "yz"),
+            ("a|bcd", None), ("ab*c", None), ("(?i)abc", None),
+        ]:
+            self.assertEqual(required_literal(re.compile(pattern)), literal)
+
+        cmd = MatchCommand({
+            "path": {"$regex": "^/api/(user|item)s?$"}
+        })
+        self.assertIn("'/api/' in", cmd.match.source)
+        docs = [
+            Document({"path": "/api/users"}),
+            Document({"path": u"/api/item"}),
+            Document({"path": "/web/api/users"}),
+            Document({"path": "/static"}),
+            Document({"path": 1}),
+        ]
+        for doc in docs:
+            self.assertEqual(cmd.match(doc), cmd.match_operators(doc))
+            cmd.feed(doc)
+        self.assertListEqual(cmd.result(), docs[:2])
+
+        cmd = ProjectCommand({
+            "user": {"$extract": ["$_event", "user=(\w+)"]},
+        })
+        self.assertIn("'user=' in", cmd.project.source)
+        for doc in [Document({"_event": "login user=tom"}), Document({"_event": "logout"})]:
+            self.assertEqual(cmd.project(doc), cmd.project_operators(doc))
+
+    def test_or_alternatives(self):
+        cmd = MatchCommand({
+            "$or": [
+                {"msg": {"$regex": "timeout"}},
+                {"app": "web"},
+                {"msg": "ok"},
+                {"msg": {"$in": ["done", "skip"]}},
+                {"msg": {"$regex": "err(\d+)"}},
+                {"msg": {"$regex": "(a)\\1"}},
+            ]
+        })
+        sub_ops = cmd.operators[0].sub_ops
+        self.assertEqual(len(sub_ops), 2)
+        self.assertEqual(sub_ops[0].explain()["alternatives"], 5)
+        self.assertEqual(len(sub_ops[0].searches), 2)
+        docs = [
+            Document({"msg": "read timeout"}),
+            Document({"msg": ["x", "done"]}),
+            Document({"msg": "err42", "app": "api"}),
+            Document({"msg": "aa"}),
+            Document({"msg": "ok!", "app": "web"}),
+            Document({"msg": "ok!"}),
+            Document({"msg": 1}),
+            Document({"app": "api"}),
+        ]
+        for doc in docs:
+            self.assertEqual(cmd.match(doc), cmd.match_operators(doc))
+            cmd.feed(doc)
+        self.assertListEqual(cmd.result(), docs[:5])
+
+        cmd = MatchCommand({"$nor": [{"msg": "ok"}, {"msg": {"$regex": "^err"}}]})
+        for doc in [Document({"msg": "ok"}), Document({"msg": "error"}), Document({"msg": "okay"})]:
+            cmd.feed(doc)
+        self.assertListEqual(cmd.result(), [Document({"msg": "okay"})])
+
     def test_lt(self):
         cmd = MatchCommand({
             "elapse": {"$lt": 3}
@@ -294,6 +376,60 @@ class MatchCommandTest(unittest.TestCase):
             Document({"students": [{"name": "jan", "school": 23}]})
         ])
 
+    def test_compiled(self):
+        specs = [
+            {"app": {"$regex": "app[12]"}, "elapse": {"$gte": 2, "$lt": 9}},
+            {"elapse": {"$in": [1, 3, 5, None]}, "tags": {"$nin": ["tag1"]}},
+            {"tags": {"$all": ["tag1", "tag2"]}, "flag.fin": {"$exists": True}},
+            {"$or": [{"app": "app1"}, {"elapse": {"$mod": [3, 1]}}], "$nor": [{"tags": "tag3"}]},
+            {"$and": [{"app": {"$ne": "app3"}}, {"elapse": {"$not": {"$gt": 5}}}]},
+            {"ips": {"$elemMatch": {"ip": {"$regex": "^192"}, "port": {"$gt": 80}}}},
+            {"flag.fin": {"$in": [[1], 0]}, "$call": lambda doc: doc.get("elapse", 0) % 2 == 0},
+            {"ips.port": 80, "app": {"$exists": False}},
+            {"ips": {"$elemMatch": {"host.name": "h1"}}},
+        ]
+        docs = []
+        for i in range(60):
+            doc = {"elapse": i % 10, "tags": ["tag%d" % (i % 4), "tag2"][:i % 3]}
+            if i % 5:
+                doc["app"] = "app%d" % (i % 4)
+            if i % 7 == 0:
+                doc["flag"] = {"fin": [1] if i % 2 else i % 3}
+            if i % 3 == 0:
+                doc["ips"] = [{"ip": "192.168.1.%d" % i, "port": 80 + i % 3, "host": {"name": "h%d" % (i % 2)}}, "other"]
+            docs.append(Document(doc))
+        for spec in specs:
+            cmd = MatchCommand(spec)
+            self.assertTrue(hasattr(cmd.match, "source"))
+            for doc in docs:
+                self.assertEqual(cmd.match(doc), cmd.match_operators(doc))
+
+        cmd = MatchCommand({"ts": {"$gt": datetime.datetime(2014, 1, 1)}})
+        self.assertTrue(cmd.match(Document({"ts": datetime.datetime(2014, 1, 2)})))
+        with self.assertRaises(OperatorError):
+            cmd.match(Document({"ts": 1}))
+
+    def test_compiled_errors(self):
+        called = []
+
+        def call(doc):
+            called.append(doc["app"])
+            if doc["app"] == "bad":
+                raise ValueError("bad app")
+            return True
+
+        cmd = MatchCommand({"$and": [{"$call": call}, {"ts": {"$gt": datetime.datetime(2014, 1, 1)}}]})
+        for doc, message in [
+            (Document({"app": "app1", "ts": 1}), "$gt runtime error"),
+            (Document({"app": "bad", "ts": datetime.datetime(2014, 1, 2)}), "$call runtime error: bad app"),
+        ]:
+            for match in [cmd.match, cmd.match_operators]:
+                del called[:]
+                with self.assertRaises(OperatorError) as ctx:
+                    match(doc)
+                self.assertIn(message, str(ctx.exception))
+                self.assertEqual(called, [doc["app"]])
+
 
 class ProjectCommandTest(unittest.TestCase):
 
@@ -338,6 +474,66 @@ class ProjectCommandTest(unittest.TestCase):
             Document({"appid": '1'}),
         ])
 
+    def test_compiled_errors(self):
+        called = []
+
+        def call(doc):
+            called.append(doc["app"])
+            if doc["app"] == "bad":
+                raise ValueError("bad app")
+            return doc["app"]
+
+        cmd = ProjectCommand({
+            "app": {"$call": call},
+            "parts": {"name": {"$toUpper": {"$call": call}}, "n": {"$add": ["$elapse", 1]}},
+            "elapse": {"$add": ["$elapse", 1]},
+        })
+        for doc, message in [
+            (Document({"app": "app1", "elapse": "x"}), "$add only supports numeric types"),
+            (Document({"app": "bad", "elapse": 1}), "$call runtime error: bad app"),
+        ]:
+            calls = []
+            for project in [cmd.project, cmd.project_operators]:
+                del called[:]
+                with self.assertRaises(OperatorError) as ctx:
+                    project(doc)
+                self.assertIn(message, str(ctx.exception))
+                calls.append(list(called))
+            self.assertEqual(calls[0], calls[1])
+
+        cmd = GroupCommand({"_id": None, "apps": {"$push": {"$call": call}}})
+        cmd.feed(Document({"app": "app1"}))
+        del called[:]
+        with self.assertRaises(OperatorError) as ctx:
+            cmd.feed(Document({"app": "bad"}))
+        self.assertIn("$push runtime error: bad app", str(ctx.exception))
+        self.assertEqual(called, ["bad"])
+
+    def test_extract_shared(self):
+        cmd = ProjectCommand({
+            "app": {"$extract": ["$_event", "app:(?P<extract>\w*)"]},
+            "action": {"$extract": ["$_event", "(cached|refresh)"]},
+            "elapse": {"$toNumber": {"$extract": ["$_event", "elapse:([\d.]*)"]}},
+            "word": {"$extract": ["$_event", "c\w+"]},
+            "appid": {"$extract": ["$_event", "app:(?P<extract>\w*)"]},
+        })
+        self.assertEqual(cmd.project.source.count("'_event'"), 1)
+        self.assertEqual(cmd.project.source.count(".group("), 5)
+        self.assertEqual(cmd.project.source.count("isinstance"), 1)
+        self.assertEqual(len(re.findall(r" = _c\d+\(_v", cmd.project.source)), 4)
+        docs = [
+            Document({"_event": "Collect app:app37 end... refresh, elapse:1.0"}),
+            Document({"_event": "Collect app:app40 cached"}),
+            Document({"_event": "nothing"}),
+        ]
+        for doc in docs:
+            self.assertEqual(cmd.project(doc), cmd.project_operators(doc))
+        self.assertEqual(cmd.project(docs[0]), {
+            "app": "app37", "action": "refresh", "elapse": 1.0, "word": "ct", "appid": "app37"
+        })
+        with self.assertRaises(OperatorError):
+            cmd.project(Document({"_event": 1}))
+
     def test_timestamp(self):
         cmd = ProjectCommand({
             "ts": {"$timestamp": ["$time", "%Y-%m-%d %H:%M:%S"]},
@@ -347,6 +543,27 @@ class ProjectCommandTest(unittest.TestCase):
             Document({"ts": 1390669200.0}),
         ])
 
+    def test_timestamp_formats(self):
+        import time
+        from pipestat.utils import TimestampParser
+        for fmt, values in [
+            ("%Y-%m-%d %H:%M:%S", ["2014-01-26 01:00:00", "2014-01-26 01:59:59", u"2014-12-31 23:00:01",
+                                   "2014-1-26 01:00:00", "2014-01-26  01:00:00", "2014-02-30 01:00:00"]),
+            ("%Y-%m-%dT%H:%M:%SZ", ["2014-01-26T01:02:03Z", "2014-01-26t01:02:03z", "2014-01-26T01:02:60Z"]),
+            ("%Y-%m-%d %H:%M:%S,%f", ["2014-01-26 01:02:03,456", "2014-01-26 01:02:03,4567890"]),
+            ("%d/%b/%Y:%H:%M:%S", ["26/Jan/2014:01:02:03"]),
+        ]:
+            parser = TimestampParser(fmt)
+            self.assertEqual(parser.regex is None, fmt.startswith("%d"))
+            for v in values:
+                try:
+                    expected = time.mktime(time.strptime(v, fmt))
+                except ValueError:
+                    self.assertRaises(ValueError, parser.parse, v)
+                else:
+                    self.assertEqual(parser.parse(v), expected)
+        self.assertEqual(len(TimestampParser("%Y-%m-%d %H:%M:%S").hours), 0)
+
     def test_cond(self):
         cmd = ProjectCommand({
             "state": {"$cond": [{"$gt": ["$elapse", 2]}, 1, 0]},
@@ -609,6 +826,36 @@ class ProjectCommandTest(unittest.TestCase):
             {"m": 0}
         ])
 
+    def test_dateToParts(self):
+        cmd = ProjectCommand({
+            "parts": {"$dateToParts": "$ts"},
+            "date": {"$dateToParts": {"date": "$ts"}},
+            "bucket": {"y": {"$year": "$ts"}, "m": {"$month": "$ts"}},
+            "h": {"$hour": "$ts"},
+        })
+        self.assertEqual(cmd.project.source.count("'ts'"), 1)
+        docs = [
+            Document({"ts": datetime.datetime(2014, 3, 31, 12, 30, 5, 123456)}),
+            Document({"ts": 1396240205.5}),
+            Document({"ts": datetime.date(2014, 3, 31)}),
+        ]
+        for doc in docs:
+            self.assertEqual(cmd.project(doc), cmd.project_operators(doc))
+        # timestamps are converted to local time
+        d = datetime.datetime.fromtimestamp(1396240205.5)
+        parts = {
+            "year": d.year, "month": d.month, "day": d.day, "hour": d.hour,
+            "minute": d.minute, "second": d.second, "millisecond": 500,
+        }
+        self.assertEqual(cmd.project(docs[1]), {
+            "parts": parts,
+            "date": parts,
+            "bucket": {"y": d.year, "m": d.month},
+            "h": d.hour,
+        })
+        with self.assertRaises(OperatorError):
+            cmd.project(Document({"ts": "2014"}))
+
     def test_call(self):
         cmd = ProjectCommand({
             "elapse": {"$call": lambda doc: 2*(doc["elapse"]+2)},
@@ -651,6 +898,36 @@ class ProjectCommandTest(unittest.TestCase):
             Document({"elapse": 14}),
         ])
 
+    def test_compiled(self):
+        cmd = ProjectCommand({
+            "app": {"$toUpper": {"$extract": ["$_event", "app:(\w*)"]}},
+            "elapse": {"$divide": [{"$add": ["$elapse", 1]}, "$count"]},
+            "name": {"$concat": ["$first", " ", {"$toLower": "$last"}]},
+            "short": {"$substr": ["$first", 0, 2]},
+            "state": {"$cond": [{"$gte": ["$count", 2]}, "$first", "none"]},
+            "hour": {"$hour": "$ts"},
+            "flag.fin": "$flag",
+            "detail": {"count": "$count", "missing": "$missing"},
+        })
+        self.assertTrue(hasattr(cmd.project, "source"))
+        docs = [
+            Document({
+                "_event": "app:app%d" % i, "elapse": i, "count": i % 3,
+                "first": "Tim", "last": "YUAN", "ts": 1390669200 + i * 3600,
+                "flag": i % 2,
+            })
+            for i in range(1, 6)
+        ]
+        docs.append(Document({"_event": "none", "first": "Jo", "count": 1, "ts": 0}))
+        for doc in docs:
+            if doc["count"]:
+                self.assertEqual(cmd.project(doc), cmd.project_operators(doc))
+            else:
+                with self.assertRaises(OperatorError):
+                    cmd.project(doc)
+        self.assertEqual(cmd.project(docs[1])["state"], "Tim")
+        self.assertEqual(cmd.project(docs[0])["flag"], {"fin": 1})
+
 
 class GroupCommandTest(unittest.TestCase):
 
@@ -792,6 +1069,152 @@ class GroupCommandTest(unittest.TestCase):
             {"_id": "app1", "elapse": 3},
         ])
 
+    def test_merge(self):
+        def nsum(document, acc_val):
+            return acc_val + document.get("elapse", 0)
+        nsum.init = int
+        nsum.merge = lambda a, b: a + b
+
+        docs = [
+            Document({"elapse": 3, "ips": ["1.1.1.1"], "app": "app1"}),
+            Document({"elapse": 1, "ips": ["1.1.1.2", "1.1.1.1"]}),
+            Document({"elapse": 5, "ips": [], "app": "app2"}),
+            Document({"ips": ["1.1.1.3"], "app": "app3"}),
+        ]
+        specs = [
+            {"$sum": "$elapse"}, {"$min": "$elapse"}, {"$max": "$elapse"},
+            {"$first": "$app"}, {"$last": "$app"}, {"$addToSet": "$app"}, {"$push": "$app"},
+            {"$concatToSet": "$ips"}, {"$concatToList": "$ips"}, {"$call": nsum},
+            {"sum": {"$sum": 1}, "ips": {"$push": "$ips"}},
+        ]
+        for spec in specs:
+            op = OperatorFactory.new_group("v", spec)
+            self.assertTrue(op.mergeable)
+            for i in range(len(docs) + 1):
+                acc_vals = []
+                for part in [docs[:i], docs[i:], docs]:
+                    acc_val = op.init_val()
+                    for doc in part:
+                        acc_val = op.group(doc, acc_val)
+                    acc_vals.append(acc_val)
+                merged = op.result(op.merge(acc_vals[0], acc_vals[1]))
+                expected = op.result(acc_vals[2])
+                if "$addToSet" in spec or "$concatToSet" in spec:
+                    merged, expected = sorted(merged), sorted(expected)
+                self.assertEqual(merged, expected)
+
+        op = OperatorFactory.new_group("v", {"$call": lambda doc, acc_val: acc_val})
+        self.assertFalse(op.mergeable)
+        with self.assertRaises(OperatorError):
+            op.merge(1, 2)
+
+    def test_spill(self):
+        dataset = [
+            {"app": "app%d" % (i % 13), "tags": ["tag%d" % (i % 3)], "elapse": (i * 37) % 11}
+            for i in range(200)
+        ]
+        pipelines = [
+            [{"$group": {
+                "_id": {"app": "$app", "tags": "$tags"},
+                "count": {"$sum": 1},
+                "first": {"$first": "$elapse"},
+                "last": {"$last": "$elapse"},
+                "elapses": {"$push": "$elapse"},
+                "max": {"$max": "$elapse"},
+            }}],
+            [{"$group": {"_id": "$elapse", "apps": {"$addToSet": "$app"}}}, {"$limit": 4}],
+        ]
+        for pipeline in pipelines:
+            expected = pipestat(dataset, pipeline)
+            for buffer_size in [1, 5]:
+                p = Pipeline(pipeline, buffer_size=buffer_size)
+                p.feed_many(dataset)
+                self.assertIsNotNone(p.cmd.partitions)
+                result = p.result()
+                self.assertIsNone(p.cmd.partitions)
+                if "$limit" in pipeline[-1]:
+                    self.assertEqual(len(result), len(expected))
+                else:
+                    self.assertEqual(sorted(result), sorted(expected))
+
+    def test_sorted(self):
+        dataset = [{"app": "app%d" % (i % 4), "tag": i % 3, "elapse": i} for i in range(30)]
+        dataset[3]["app"] = None
+        del dataset[7]["app"]
+        group = {"_id": "$app", "count": {"$sum": 1}, "elapses": {"$push": "$elapse"}}
+        expected = sorted(pipestat(dataset, [{"$group": group}]))
+
+        p = Pipeline([{"$sort": {"app": 1}}, {"$group": group}])
+        self.assertIsInstance(p.cmd.next, SortedGroupCommand)
+        p.feed_many(dataset)
+        self.assertEqual(sorted(p.result()), expected)
+
+        group = {"_id": {"tag": "$tag", "app": "$app"}, "count": {"$sum": 1}}
+        pipeline = [{"$sort": [("app", -1), ("tag", 1), ("elapse", 1)]}, {"$group": group}, {"$limit": 5}]
+        p = Pipeline(pipeline)
+        self.assertIsInstance(p.cmd.next, SortedGroupCommand)
+        self.assertEqual(len(pipestat(dataset, pipeline)), 5)
+        pipeline = [{"$sort": [("app", -1), ("tag", 1), ("elapse", 1)]}, {"$group": group}]
+        self.assertEqual(sorted(pipestat(dataset, pipeline)), sorted(pipestat(dataset, pipeline[1:])))
+
+        p = Pipeline([{"$sort": [("tag", 1), ("elapse", 1)]}, {"$group": group}])
+        self.assertNotIsInstance(p.cmd.next, SortedGroupCommand)
+
+        # None and missing fields are interleaved in sorted order
+        dataset = [{"a": None}, {}, {"a": None}, {}, {"a": 1}]
+        group = {"_id": {"a": "$a"}, "n": {"$sum": 1}}
+        pipeline = [{"$sort": {"a": 1}}, {"$group": group}]
+        self.assertIsInstance(Pipeline(pipeline).cmd.next, SortedGroupCommand)
+        self.assertEqual(sorted(pipestat(dataset, pipeline)), sorted([
+            {"_id": {"a": None}, "n": 2}, {"_id": {}, "n": 2}, {"_id": {"a": 1}, "n": 1},
+        ]))
+        dataset = [{"a": 1, "b": None}, {"a": 1}, {"a": 1, "b": None}, {"a": 1, "b": 2}, {"a": 2}]
+        group = {"_id": {"a": "$a", "b": "$b"}, "n": {"$sum": 1}}
+        pipeline = [{"$sort": [("a", 1), ("b", 1)]}, {"$group": group}]
+        self.assertEqual(sorted(pipestat(dataset, pipeline)), sorted(pipestat(dataset, pipeline[1:])))
+
+        p = Pipeline([{"$group": {"_id": "$tag", "count": {"$sum": 1}}}], presorted=True)
+        self.assertIsInstance(p.cmd, SortedGroupCommand)
+        self.assertEqual(p.push([{"tag": 1}, {"tag": 1}, {"tag": 2}]), [{"_id": 1, "count": 2}])
+        self.assertEqual(p.push([{}, {"tag": 2}, {"tag": 3}]), [{"_id": 2, "count": 2}])
+        self.assertEqual(p.result(), [{"_id": None, "count": 1}, {"_id": 3, "count": 1}])
+
+    def test_compiled_id(self):
+        cmd = GroupCommand({
+            "_id": {"app": {"$toUpper": "$app"}, "slot": {"$subtract": ["$ts", {"$mod": ["$ts", 10]}]}},
+            "count": {"$sum": 1},
+            "elapse": {"$sum": {"$multiply": ["$elapse", 2]}},
+        })
+        cmd.feed(Document({"app": "app1", "ts": 13, "elapse": 1}))
+        cmd.feed(Document({"app": "app1", "ts": 17, "elapse": 2}))
+        cmd.feed(Document({"app": "app2", "ts": 21}))
+        self.assertEqual(sorted(cmd.result()), sorted([
+            {"_id": {"app": "APP1", "slot": 10}, "count": 2, "elapse": 6},
+            {"_id": {"app": "APP2", "slot": 20}, "count": 1, "elapse": 0},
+        ]))
+
+    def test_id_key(self):
+        cmd = GroupCommand({"_id": "$v", "count": {"$sum": 1}})
+        for v in [-1, -2, [1, 2], [1, 2], {"a": [1]}, {"a": [1]}, {"a": (1,)}, -1]:
+            cmd.feed(Document({"v": v}))
+        self.assertListEqual(cmd.result(), [
+            {"_id": -1, "count": 2},
+            {"_id": -2, "count": 1},
+            {"_id": [1, 2], "count": 2},
+            {"_id": {"a": [1]}, "count": 3},
+        ])
+
+        cmd = GroupCommand({"_id": {"app": "$app", "tags": "$tags"}, "count": {"$sum": 1}})
+        cmd.feed(Document({"app": "app1", "tags": ["a"]}))
+        cmd.feed(Document({"app": "app1", "tags": ["a"]}))
+        cmd.feed(Document({"tags": ["a"]}))
+        cmd.feed(Document({"app": None, "tags": ["a"]}))
+        self.assertListEqual(cmd.result(), [
+            {"_id": {"app": "app1", "tags": ["a"]}, "count": 2},
+            {"_id": {"tags": ["a"]}, "count": 1},
+            {"_id": {"app": None, "tags": ["a"]}, "count": 1},
+        ])
+
 
 class SortCommandTest(unittest.TestCase):
 
@@ -819,6 +1242,101 @@ class SortCommandTest(unittest.TestCase):
             Document({"app": "app1", "elapse": 1}),
         ])
 
+    def test_sort_stable(self):
+        cmd = SortCommand([
+            ("app", -1),
+            ("elapse", 1),
+        ])
+        cmd.feed(Document({"app": "app1", "elapse": 2, "seq": 1}))
+        cmd.feed(Document({"app": "app2", "elapse": 3, "seq": 2}))
+        cmd.feed(Document({"app": "app1", "elapse": 1, "seq": 3}))
+        cmd.feed(Document({"app": "app1", "elapse": 2, "seq": 4}))
+        cmd.feed(Document({"elapse": 0, "seq": 5}))
+        self.assertListEqual([doc["seq"] for doc in cmd.result()], [2, 3, 1, 4, 5])
+
+    def test_sort_undefined(self):
+        cmd = SortCommand({"elapse": 1})
+        cmd.feed(Document({"elapse": "a"}))
+        cmd.feed(Document({"elapse": undefined}))
+        cmd.feed(Document({"elapse": 3}))
+        cmd.feed(Document({"elapse": undefined}))
+        cmd.feed(Document({"elapse": None}))
+        self.assertListEqual([doc["elapse"] for doc in cmd.result()], [
+            None, 3, undefined, undefined, "a"
+        ])
+
+    def test_spill(self):
+        dataset = [{"app": "app%d" % (i % 7), "elapse": (i * 37) % 11, "i": i} for i in range(100)]
+        dataset[5]["elapse"] = undefined
+        del dataset[9]["app"]
+        pipelines = [
+            [{"$sort": [("app", 1), ("elapse", -1)]}],
+            [{"$sort": {"elapse": 1}}, {"$project": {"i": 1}}, {"$limit": 20}],
+        ]
+        for pipeline in pipelines:
+            expected = pipestat(dataset, pipeline)
+            for buffer_size in [1, 7, 30]:
+                self.assertEqual(pipestat(dataset, pipeline, batch_size=9, buffer_size=buffer_size), expected)
+
+        cmd = SortCommand({"elapse": 1})
+        cmd.buffer_size = 2
+        for doc in dataset[:5]:
+            cmd.feed(Document(doc))
+        self.assertEqual(len(cmd.runs), 2)
+        self.assertEqual([doc["i"] for doc in cmd.result()], [0, 3, 1, 4, 2])
+        self.assertEqual(cmd.runs, [])
+
+    def test_spill_partial_order(self):
+        # sets are ordered by inclusion only, descending runs are merged
+        # with `<` like they are sorted, instead of cmp which rejects them
+        sets = [set([2]), set([1]), set([1, 2]), set([3]), set([1, 2, 3]), set()]
+        dataset = [{"s": s, "i": i} for i, s in enumerate(sets)]
+        for direction in [1, -1]:
+            pipeline = [{"$sort": {"s": direction}}]
+            for buffer_size in [None, 1, 2, 4]:
+                result = pipestat(dataset, pipeline, batch_size=1, buffer_size=buffer_size)
+                self.assertEqual(sorted(doc["i"] for doc in result), range(len(sets)))
+
+        # totally ordered keys sort the same whether runs are spilled or not
+        dataset = [{"a": [None, 1, "x", (i * 3) % 4, 2.5][i % 5], "b": -i} for i in range(40)]
+        for pipeline in [[{"$sort": [("a", -1), ("b", 1)]}], [{"$sort": [("a", 1), ("b", -1)]}]]:
+            expected = pipestat(dataset, pipeline)
+            for buffer_size in [1, 3, 16]:
+                self.assertEqual(pipestat(dataset, pipeline, batch_size=1, buffer_size=buffer_size), expected)
+
+        # only entries which may be spilled are keyed by wrapped values
+        cmd = SortCommand([("a", -1), ("b", 1)])
+        cmd.feed(Document({"a": 1, "b": 2}))
+        self.assertEqual(cmd.entries[0][0], (1, 2))
+        cmd = SortCommand([("a", -1), ("b", 1)])
+        cmd.buffer_size = 10
+        cmd.feed(Document({"a": 1, "b": 2}))
+        self.assertEqual(cmd.entries[0][0], cmd.merge_key(Document({"a": 1, "b": 2})))
+        self.assertEqual(cmd.entries[0][0][0].value, 1)
+
+
+class SortLimitCommandTest(unittest.TestCase):
+
+    def test_sort_limit(self):
+        dataset = [{"app": "app%d" % (i % 7), "elapse": (i * 37) % 101} for i in range(500)]
+        pipeline = [
+            {"$sort": [("app", 1), ("elapse", -1)]},
+            {"$skip": 3},
+            {"$limit": 10},
+        ]
+        p = Pipeline(pipeline)
+        self.assertIsInstance(p.cmd, SortLimitCommand)
+        self.assertEqual(p.cmd.limit, 13)
+
+        expected = sorted(dataset, key=lambda x: (x["app"], -x["elapse"]))[3:13]
+        self.assertListEqual(pipestat(dataset, pipeline), expected)
+        expected = sorted(dataset[:5], key=lambda x: (x["app"], -x["elapse"]))[3:]
+        self.assertListEqual(pipestat(dataset[:5], pipeline), expected)
+
+    def test_sort_without_limit(self):
+        p = Pipeline([{"$sort": {"app": 1}}, {"$skip": 3}])
+        self.assertNotIsInstance(p.cmd, SortLimitCommand)
+
 
 class SkipCommandTest(unittest.TestCase):
 
@@ -860,6 +1378,470 @@ class UnwindCommandTest(unittest.TestCase):
         ])
 
 
+class OptimizerTest(unittest.TestCase):
+
+    def test_merge(self):
+        optimizer = Optimizer()
+        pipeline = optimizer.optimize([
+            {"$match": {"app": "app1"}},
+            {"$match": {"elapse": {"$gt": 1}}},
+            {"$match": {"app": {"$ne": "app2"}}},
+            {"$skip": 1},
+            {"$skip": 2},
+            {"$limit": 5},
+            {"$limit": 3},
+        ])
+        self.assertEqual(pipeline, [
+            {"$match": {"$and": [
+                {"app": "app1", "elapse": {"$gt": 1}},
+                {"app": {"$ne": "app2"}},
+            ]}},
+            {"$skip": 3},
+            {"$limit": 3},
+        ])
+
+        dataset = [{"i": i} for i in range(10)]
+        pipeline = [{"$skip": 3}, {"$skip": -5}]
+        self.assertEqual(Optimizer().optimize(pipeline), [{"$skip": 3}])
+        self.assertEqual(pipestat(dataset, pipeline), dataset[3:])
+
+    def test_noop(self):
+        optimizer = Optimizer()
+        pipeline = optimizer.optimize([
+            {"$match": {}},
+            {"$skip": 0},
+            {"$sort": []},
+            {"$limit": 3},
+        ])
+        self.assertEqual(pipeline, [{"$limit": 3}])
+        self.assertEqual(optimizer.optimize([{"$match": {}}]), [{"$match": {}}])
+
+    def test_reorder(self):
+        optimizer = Optimizer()
+        pipeline = optimizer.optimize([
+            {"$project": {"app": 1, "elapse": "$elapse", "tags": 1, "ts": "$time"}},
+            {"$unwind": "$tags"},
+            {"$sort": {"elapse": 1}},
+            {"$match": {"app": "app1", "$or": [{"elapse.max": 1}, {"elapse": 2}]}},
+            {"$match": {"tags": "tag1"}},
+            {"$match": {"ts": 1}},
+            {"$project": {"app": 1}},
+            {"$limit": 3},
+        ])
+        self.assertEqual(pipeline, [
+            {"$match": {"app": "app1", "$or": [{"elapse.max": 1}, {"elapse": 2}]}},
+            {"$project": {"app": 1, "elapse": "$elapse", "tags": 1, "ts": "$time"}},
+            {"$unwind": "$tags"},
+            {"$match": {"tags": "tag1", "ts": 1}},
+            {"$sort": {"elapse": 1}},
+            {"$limit": 3},
+            {"$project": {"app": 1}},
+        ])
+
+        pipeline = [
+            {"$project": {"app": {"$toUpper": "$app"}}},
+            {"$match": {"$call": lambda doc: True}},
+            {"$unwind": "$tags"},
+            {"$match": {"tags.name": "tag1"}},
+            {"$unwind": "$ips"},
+            {"$limit": 3},
+        ]
+        self.assertEqual(Optimizer().optimize(pipeline), pipeline)
+
+        # a.c is computed, it does not pass through with a
+        dataset = [{"a": {"c": i}, "n": i} for i in range(10)]
+        pipeline = [
+            {"$project": {"a": 1, "a.c": {"$add": ["$n", 100]}}},
+            {"$match": {"a.c": {"$gt": 105}}},
+        ]
+        self.assertEqual(Optimizer().optimize(pipeline), pipeline)
+        self.assertEqual([doc["a"]["c"] for doc in pipestat(dataset, pipeline)], [106, 107, 108, 109])
+
+    def test_pipeline(self):
+        dataset = [{"app": "app%d" % (i % 3), "elapse": i} for i in range(10)]
+        pipeline = [
+            {"$project": {"app": 1, "elapse": 1, "double": {"$multiply": ["$elapse", 2]}}},
+            {"$match": {"app": "app1"}},
+            {"$match": {"elapse": {"$gt": 1}}},
+            {"$sort": {"elapse": -1}},
+            {"$project": {"elapse": 1, "double": 1}},
+            {"$limit": 2},
+        ]
+        results = [
+            {"elapse": 7, "double": 14},
+            {"elapse": 4, "double": 8},
+        ]
+        self.assertEqual(pipestat(dataset, pipeline), results)
+        p = Pipeline(pipeline)
+        self.assertIsInstance(p.cmd, MatchCommand)
+        self.assertIsInstance(p.cmd.next.next, SortLimitCommand)
+
+
+class ExplainTest(unittest.TestCase):
+
+    def test_explain(self):
+        p = Pipeline([
+            {"$project": {"_event": 1, "app": {"$extract": ["$_event", "app:(\w*)"]}}},
+            {"$match": {"_event": {"$regex": "timeline"}}},
+            {"$group": {"_id": "$app", "count": {"$sum": 1}, "max": {"$max": {"$toNumber": "$elapse"}}}},
+            {"$sort": {"count": -1}},
+            {"$limit": 3},
+        ])
+        plan = p.explain()
+        self.assertEqual(plan["actions"], [
+            "moved $match ahead of $project",
+            "fused $sort with following $limit, keep 3 documents",
+        ])
+        self.assertEqual([s["class"] for s in plan["stages"]], [
+            "MatchCommand", "ProjectCommand", "GroupCommand", "SortLimitCommand", "LimitCommand"
+        ])
+        match, project, group, sort, limit = plan["stages"]
+        self.assertEqual(match["reads"], ["_event"])
+        self.assertEqual(match["operators"][0]["operator"], "$regex")
+        self.assertEqual(project["writes"], ["_event", "app"])
+        self.assertEqual(group["reads"], ["app", "elapse"])
+        self.assertEqual(group["writes"], ["_id", "count", "max"])
+        max_op = [op for op in group["operators"] if op["field"] == "max"][0]
+        self.assertEqual(max_op["operands"][0]["operator"], "$toNumber")
+        self.assertEqual(max_op["operands"][0]["reads"], ["elapse"])
+        self.assertEqual(sort["limit"], 3)
+
+
+class ProfileTest(unittest.TestCase):
+
+    def test_profile(self):
+        p = Pipeline([
+            {"$match": {"elapse": {"$gt": 1}}},
+            {"$project": {"app": 1, "elapse": {"$divide": ["$elapse", "$count"]}}},
+            {"$group": {"_id": "$app", "elapse": {"$sum": "$elapse"}}},
+        ], profile=True)
+        for doc in [
+            {"app": "app1", "elapse": 1, "count": 1},
+            {"app": "app1", "elapse": 4, "count": 2},
+            {"app": "app2", "elapse": 6, "count": 3},
+        ]:
+            p.feed(doc)
+        with self.assertRaises(OperatorError):
+            p.feed({"app": "app2", "elapse": 2, "count": "3"})
+        p.result()
+
+        stats = p.stats()
+        match, project, group = stats["stages"]
+        self.assertEqual((match["in"], match["out"], match["errors"]), (4, 3, 1))
+        self.assertEqual(match["operators"][0]["operator"], "$gt")
+        self.assertEqual((match["operators"][0]["in"], match["operators"][0]["out"]), (4, 3))
+        self.assertEqual((project["in"], project["out"], project["errors"]), (3, 2, 1))
+        divide = [op for op in project["operators"] if op["field"] == "elapse"][0]
+        self.assertEqual((divide["in"], divide["out"], divide["errors"]), (3, 2, 1))
+        self.assertEqual((group["in"], group["out"], group["errors"]), (2, 2, 0))
+        self.assertTrue(stats["time"] >= match["time"] >= 0)
+
+        with self.assertRaises(PipelineError):
+            Pipeline([{"$skip": 1}]).stats()
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset = [
+            {"app": "app%d" % (i % 3), "elapse": i, "tags": ["tag%d" % (i % 2), "tag2"]}
+            for i in range(20)
+        ]
+
+    def run_pipeline(self, pipeline, batch_size):
+        return pipestat(self.dataset, pipeline, batch_size=batch_size)
+
+    def test_batch(self):
+        pipelines = [
+            [
+                {"$match": {"elapse": {"$gte": 3}}},
+                {"$unwind": "$tags"},
+                {"$project": {"app": 1, "tags": 1, "elapse": {"$add": ["$elapse", 1]}}},
+                {"$skip": 5},
+                {"$limit": 12},
+            ],
+            [
+                {"$unwind": "$tags"},
+                {"$group": {"_id": {"app": "$app", "tag": "$tags"}, "count": {"$sum": 1}}},
+                {"$sort": [("_id.app", 1), ("_id.tag", -1)]},
+                {"$skip": 1},
+                {"$limit": 3},
+            ],
+            [
+                {"$project": {"tags": 0}},
+                {"$limit": 0},
+            ],
+        ]
+        for pipeline in pipelines:
+            expected = self.run_pipeline(pipeline, 1)
+            for batch_size in [2, 7, 1000]:
+                self.assertEqual(self.run_pipeline(pipeline, batch_size), expected)
+
+    def test_batch_limit(self):
+        dataset = self.dataset[:7] + [{"app": "bad", "elapse": "x", "tags": "tag0"}] + self.dataset[7:]
+        for batch_size in [1, 4, 1000]:
+            called = []
+
+            def call(doc):
+                called.append(doc["elapse"])
+                return doc["elapse"]
+
+            pipeline = [
+                {"$match": {"app": {"$ne": "app1"}}},
+                {"$project": {"e": {"$call": call}, "double": {"$add": ["$elapse", "$elapse"]}}},
+                {"$match": {"double": {"$gte": 0}}},
+                {"$skip": 1},
+                {"$limit": 3},
+            ]
+            self.assertEqual(pipestat(dataset, pipeline, batch_size=batch_size), [
+                {"e": i, "double": 2 * i} for i in [2, 3, 5]
+            ])
+            self.assertEqual(called, [0, 2, 3, 5, 6])
+
+            pipeline = [{"$unwind": "$tags"}, {"$limit": 12}]
+            self.assertEqual(len(pipestat(dataset, pipeline, batch_size=batch_size)), 12)
+
+    def test_stream(self):
+        pipelines = [
+            [{"$match": {"elapse": {"$gte": 3}}}, {"$unwind": "$tags"}, {"$skip": 2}, {"$limit": 9}],
+            [{"$unwind": "$tags"}, {"$sort": {"elapse": -1}}, {"$project": {"elapse": 1}}],
+            [{"$group": {"_id": "$app", "count": {"$sum": 1}}}],
+        ]
+        for pipeline in pipelines:
+            self.assertEqual(list(pipestat_iter(self.dataset, pipeline, batch_size=3)), pipestat(self.dataset, pipeline))
+
+        consumed = []
+
+        def dataset():
+            for doc in self.dataset:
+                consumed.append(doc)
+                yield doc
+        stream = pipestat_iter(dataset(), [{"$match": {"elapse": {"$gte": 3}}}], batch_size=2)
+        self.assertEqual(next(stream)["elapse"], 3)
+        self.assertEqual(len(consumed), 4)
+
+        p = Pipeline([{"$project": {"elapse": 1}}], profile=True)
+        self.assertEqual(len(list(p.stream(self.dataset, batch_size=3))), 20)
+        self.assertEqual(p.stats()["stages"][-1]["out"], 20)
+
+    def test_push(self):
+        p = Pipeline([{"$match": {"elapse": {"$gte": 3}}}, {"$limit": 5}])
+        self.assertEqual(p.push(self.dataset[:2]), [])
+        self.assertEqual([doc["elapse"] for doc in p.push(self.dataset[2:6])], [3, 4, 5])
+        self.assertFalse(p.completed)
+        self.assertEqual([doc["elapse"] for doc in p.push(self.dataset[6:])], [6, 7])
+        self.assertTrue(p.completed)
+        self.assertEqual(p.push(self.dataset), [])
+        self.assertEqual(p.result(), [])
+
+        p = Pipeline([{"$group": {"_id": None, "count": {"$sum": 1}}}])
+        self.assertEqual(p.push(self.dataset[:5]), [])
+        self.assertEqual(p.push(self.dataset[5:]), [])
+        self.assertEqual(p.result(), [{"_id": None, "count": 20}])
+
+    def test_feed_many(self):
+        p = Pipeline([{"$skip": 2}, {"$limit": 3}])
+        p.feed_many(self.dataset[:4])
+        with self.assertRaises(LimitCompleted):
+            p.feed_many(self.dataset[4:])
+        self.assertEqual([doc["elapse"] for doc in p.result()], [2, 3, 4])
+
+
+class ParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset = [
+            {"app": "app%d" % (i % 3), "elapse": i, "tags": ["tag%d" % (i % 2), "tag2"]}
+            for i in range(30)
+        ]
+        self.sources = [self.dataset[:7], self.dataset[7:8], [], self.dataset[8:]]
+
+    def test_parallel(self):
+        pipelines = [
+            [
+                {"$match": {"elapse": {"$gte": 3}}},
+                {"$unwind": "$tags"},
+                {"$group": {
+                    "_id": {"app": "$app", "tag": "$tags"},
+                    "count": {"$sum": 1},
+                    "min": {"$min": "$elapse"},
+                    "first": {"$first": "$elapse"},
+                    "last": {"$last": "$elapse"},
+                    "elapses": {"$push": "$elapse"},
+                }},
+                {"$sort": [("_id.app", 1), ("_id.tag", -1)]},
+                {"$limit": 4},
+            ],
+            [
+                {"$project": {"app": 1, "elapse": {"$add": ["$elapse", 1]}}},
+                {"$skip": 5},
+                {"$limit": 12},
+            ],
+            [
+                {"$unwind": "$tags"},
+                {"$project": {"tags": 0}},
+            ],
+            [
+                {"$group": {"_id": "$app", "v": {"$call": lambda doc, acc_val: doc["elapse"]}}},
+                {"$sort": {"_id": 1}},
+            ],
+            [
+                {"$limit": 3},
+            ],
+        ]
+        for pipeline in pipelines:
+            expected = pipestat(self.dataset, pipeline)
+            for workers in [1, 2]:
+                self.assertEqual(pipestat_parallel(self.sources, pipeline, workers=workers), expected)
+
+    def test_error(self):
+        with self.assertRaises(OperatorError):
+            pipestat_parallel(self.sources, [{"$project": {"v": {"$substr": ["$missing", 0, 1]}}}], workers=2)
+
+    def test_parallel_workers(self):
+        import os
+        pipeline = [{"$group": {"_id": "$app", "pids": {"$addToSet": {"$call": lambda doc: os.getpid()}}}}]
+        result = pipestat_parallel(self.sources, pipeline, workers=2)
+        self.assertNotIn(os.getpid(), [pid for doc in result for pid in doc["pids"]])
+
+        def crash(doc):
+            if doc["elapse"] == 5:
+                os._exit(1)
+            return True
+
+        with self.assertRaises(PipelineError):
+            pipestat_parallel(self.sources, [{"$match": {"$call": crash}}], workers=2)
+
+    def test_pipelined(self):
+        pipeline = [
+            {"$match": {"elapse": {"$gte": 3}}},
+            {"$unwind": "$tags"},
+            {"$project": {"app": 1, "tags": 1, "elapse": {"$add": ["$elapse", 1]}}},
+            {"$group": {"_id": "$app", "elapses": {"$push": "$elapse"}}},
+            {"$sort": {"_id": -1}},
+            {"$limit": 2},
+        ]
+        expected = pipestat(self.dataset, pipeline)
+        for splits in [None, [], [2, 4], [3, 5, 99]]:
+            self.assertEqual(pipestat_pipelined(self.dataset, pipeline, splits=splits, batch_size=4), expected)
+
+        pipeline = [{"$unwind": "$tags"}, {"$limit": 5}]
+        self.assertEqual(pipestat_pipelined(iter(self.dataset), pipeline, batch_size=1), pipestat(self.dataset, pipeline))
+
+        # $sort stays in the segment of the commands fused with it
+        from pipestat.parallel import _fused_at
+        spec = [
+            {"$unwind": "$tags"},
+            {"$sort": {"app": 1}},
+            {"$group": {"_id": "$app", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$skip": 1},
+            {"$limit": 2},
+            {"$project": {"count": 1}},
+        ]
+        self.assertEqual([i for i in range(1, len(spec)) if _fused_at(spec, i)], [2, 4, 5])
+        expected = pipestat(self.dataset, spec)
+        for splits in [None, [2, 5]]:
+            self.assertEqual(pipestat_pipelined(self.dataset, spec, splits=splits, batch_size=4), expected)
+
+    def test_pipelined_errors(self):
+        import os
+        consumed = []
+
+        def source():
+            for i in itertools.count():
+                consumed.append(i)
+                yield {"v": i}
+
+        # an error stops reading the dataset, even an unbounded one
+        with self.assertRaises(OperatorError):
+            pipestat_pipelined(source(), [
+                {"$project": {"v": 1, "s": {"$substr": ["$missing", 0, 1]}}},
+                {"$match": {"v": {"$gte": 0}}},
+            ], batch_size=10, queue_size=1)
+        self.assertLess(len(consumed), 1000)
+
+        def crash(doc):
+            if doc["elapse"] == 5:
+                os._exit(3)
+            return True
+
+        for batch_size in [1, 1000]:
+            with self.assertRaises(PipelineError):
+                pipestat_pipelined(self.dataset * 50, [
+                    {"$match": {"$call": crash}},
+                    {"$project": {"elapse": 1}},
+                ], batch_size=batch_size, queue_size=1)
+
+        with self.assertRaises(OperatorError):
+            pipestat_pipelined(self.dataset, [
+                {"$project": {"v": {"$substr": ["$missing", 0, 1]}}},
+                {"$project": {"v": 1}},
+            ], batch_size=4, queue_size=1)
+
+    def test_partitioned(self):
+        pipelines = [
+            [
+                {"$match": {"elapse": {"$gte": 3}}},
+                {"$unwind": "$tags"},
+                {"$group": {
+                    "_id": {"app": "$app", "tag": "$tags"},
+                    "count": {"$sum": 1},
+                    "first": {"$first": "$elapse"},
+                    "elapses": {"$push": "$elapse"},
+                }},
+                {"$project": {"count": 1, "first": 1, "elapses": 1, "app": "$_id.app"}},
+                {"$sort": [("app", -1), ("first", 1), ("count", 1)]},
+                {"$skip": 1},
+                {"$limit": 4},
+            ],
+            [
+                {"$group": {"_id": {"$mod": ["$elapse", 7]}, "v": {"$call": lambda doc, acc_val: doc["elapse"]}}},
+                {"$match": {"v": {"$gt": 5}}},
+            ],
+            [
+                {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
+                {"$sort": [("count", -1), ("_id", 1)]},
+            ],
+            [
+                {"$sort": {"elapse": -1}},
+                {"$limit": 3},
+            ],
+        ]
+        for pipeline in pipelines:
+            expected = pipestat(self.dataset, pipeline)
+            result = pipestat_partitioned(self.dataset, pipeline, workers=3, batch_size=4)
+            if "$sort" in pipeline[-1] or "$limit" in pipeline[-1]:
+                self.assertEqual(result, expected)
+            else:
+                self.assertEqual(sorted(result), sorted(expected))
+
+        with self.assertRaises(OperatorError):
+            pipestat_partitioned(self.dataset, [
+                {"$group": {"_id": "$app", "v": {"$sum": 1}}},
+                {"$project": {"v": {"$substr": ["$v", 0, 1]}}},
+            ], workers=2)
+
+    def test_partitioned_workers(self):
+        import os
+        pipeline = [
+            {"$group": {"_id": "$app", "pid": {"$call": lambda doc, acc_val: os.getpid()}, "first": {"$first": "$elapse"}}},
+            {"$sort": {"_id": 1}},
+        ]
+        result = pipestat_partitioned(self.dataset, pipeline, workers=2)
+        self.assertEqual([doc["first"] for doc in result], [doc["first"] for doc in pipestat(self.dataset, pipeline)])
+        self.assertNotIn(os.getpid(), [doc["pid"] for doc in result])
+
+        def crash(doc, acc_val):
+            if doc["elapse"] == 5:
+                os._exit(1)
+
+        for batch_size in [1, 1000]:
+            with self.assertRaises(PipelineError):
+                pipestat_partitioned(self.dataset * 50, [{"$group": {"_id": "$app", "v": {"$call": crash}}}],
+                                     workers=2, batch_size=batch_size)
+
+
 class ErrorsTest(unittest.TestCase):
 
     def test_project(self):